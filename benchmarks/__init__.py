@@ -0,0 +1,4 @@
+"""
+Benchmarks for the status package, run against local stand-ins for every
+upstream server so that results can be compared across commits
+"""
@@ -0,0 +1,73 @@
+"""
+Contains the simulated SocketIO clients used to measure the cost of
+broadcasting an update to every connected client
+"""
+
+from gevent.queue import Queue
+from socketio import packet
+
+
+class BenchmarkNamespace:
+    """
+    The global namespace of a simulated client. Emitting to it does the same
+    work as gevent-socketio does for a real client: the packet is encoded
+    separately for every client and queued for its transport
+    """
+
+    def __init__(self, socket):
+        """Initializes the namespace of the socket"""
+        self.socket = socket
+
+    def base_emit(self, event, *args, **kwargs):
+        """Encodes the event and queues it for the client"""
+        self.socket.put_client_msg(packet.encode({
+            'type': 'event',
+            'name': event,
+            'args': args,
+            'endpoint': ''
+        }))
+
+
+class BenchmarkSocket:
+    """A simulated client connected to the global namespace"""
+
+    def __init__(self, sessid):
+        """Initializes the client with an empty outgoing queue"""
+        self.sessid = sessid
+        self.active_ns = {'': BenchmarkNamespace(self)}
+        self.client_queue = Queue()
+
+    def __getitem__(self, namespace):
+        """Returns the namespace of the client"""
+        return self.active_ns[namespace]
+
+    def put_client_msg(self, message):
+        """Queues a message for the client"""
+        self.client_queue.put_nowait(message)
+
+    def drain(self):
+        """Empties the outgoing queue and returns the number of bytes in it"""
+        size = 0
+        while not self.client_queue.empty():
+            size += len(self.client_queue.get_nowait())
+        return size
+
+
+class BenchmarkServer:
+    """
+    Stands in for the gevent-socketio server that Flask-SocketIO broadcasts
+    through, with count simulated clients connected
+    """
+
+    def __init__(self, count):
+        """Connects count simulated clients"""
+        self.sockets = dict(
+            (str(sessid), BenchmarkSocket(str(sessid)))
+            for sessid in range(count))
+
+    def drain(self):
+        """
+        Empties the outgoing queue of every client and returns the total
+        number of bytes that were queued
+        """
+        return sum(socket.drain() for socket in self.sockets.values())
@@ -0,0 +1,258 @@
+"""
+Runs the benchmarks against local stand-ins for every upstream server and
+writes the results as JSON. Run it from one level above the package:
+
+    python -m benchmarks.run --latency 0.02 --output results.json
+"""
+from __future__ import division
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+from datetime import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from benchmarks.clients import BenchmarkServer
+from benchmarks.sshserver import start_ssh_server
+from benchmarks.upstreams import FaultInjector, start_upstreams
+from status import app, socketio
+import status
+from status.functions import (REFRESH_JOBS, ForecastIO, Freenas, PfSense, Plex,
+                              Services, _compression, channels, compress)
+
+
+def summarize(durations):
+    """Returns the distribution of the durations in milliseconds"""
+    if not durations:
+        return None
+    ordered = sorted(durations)
+    return {
+        'min': ordered[0] * 1000,
+        'mean': sum(ordered) / len(ordered) * 1000,
+        'p50': ordered[len(ordered) // 2] * 1000,
+        'p95': ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] * 1000,
+        'max': ordered[-1] * 1000
+    }
+
+
+def get_commit():
+    """Returns the commit being benchmarked, or None outside of git"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD']).strip().decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def create_modules(options, base_url, ssh_port):
+    """Creates every module, pointed at the stand-ins"""
+    return {
+        'plex': lambda: Plex(
+            'benchmark', 'benchmark', base_url,
+            '{}/users/sign_in.xml'.format(base_url),
+            notifications=options.plex_notifications,
+            notifications_url='{}/:/websockets/notifications'.format(
+                base_url.replace('http', 'ws', 1))),
+        'forecast': lambda: ForecastIO(
+            'benchmark', 0, 0, base_url=base_url),
+        'pfsense': lambda: PfSense(
+            '127.0.0.1', 'benchmark', 'benchmark', [{
+                'name': 'em{}'.format(index),
+                'readable_name': 'Interface {}'.format(index),
+                'ip': '10.0.0.{}'.format(index + 1),
+                'ping_ip': '8.8.8.8',
+                'max_dl_speed': 100,
+                'max_ul_speed': 10
+            } for index in range(options.interfaces)],
+            streaming=options.streaming, port=ssh_port),
+        'services': lambda: Services([{
+            'name': 'Service {}'.format(index),
+            'hostname': 'http://127.0.0.1',
+            'port': base_url.rsplit(':', 1)[1]
+        } for index in range(options.services)]),
+        'freenas': lambda: Freenas(base_url, 'benchmark', 'benchmark')
+    }
+
+
+def benchmark_startup(factories):
+    """Creates every module, returning how long each one took to start"""
+    results = {}
+    for name, factory in factories.items():
+        start = time.time()
+        status.modules[name] = factory()
+        results[name] = (time.time() - start) * 1000
+    return results
+
+
+def benchmark_refresh(iterations):
+    """
+    Measures how long the refresh job of each module takes, including
+    fetching from the upstream and publishing its channel
+    """
+    results = {}
+    for module, update, channel, interval in REFRESH_JOBS:
+        durations = []
+        failures = 0
+        for iteration in range(iterations):
+            start = time.time()
+            try:
+                if update is not None:
+                    update()
+                channels[channel].refresh()
+            except Exception:
+                failures += 1
+                continue
+            durations.append(time.time() - start)
+        results[module] = {
+            'iterations': iterations,
+            'failures': failures,
+            'latency_ms': summarize(durations)
+        }
+    return results
+
+
+def benchmark_render(iterations):
+    """
+    Measures how many times per second each channel can be rendered, both
+    from scratch and when the HTML for the same data is reused
+    """
+    results = {}
+    for name, channel in channels.items():
+        data = channel.fetch()
+        start = time.time()
+        for iteration in range(iterations):
+            html = channel.render_uncached(data)
+        elapsed = time.time() - start
+        start = time.time()
+        for iteration in range(iterations):
+            channel.render(data)
+        reused_elapsed = time.time() - start
+        results[name] = {
+            'renders_per_second': iterations / elapsed if elapsed else None,
+            'mean_ms': elapsed / iterations * 1000,
+            'reused_mean_ms': reused_elapsed / iterations * 1000,
+            'html_bytes': len(html or '')
+        }
+    return results
+
+
+def benchmark_compression(iterations):
+    """
+    Measures the size of the full panel message of each channel before and
+    after it is deflated, and how long deflating it takes
+    """
+    _compression['threshold'] = 0
+    results = {}
+    for name, channel in channels.items():
+        encoded = json.dumps({'data': channel.render(channel.fetch())})
+        start = time.time()
+        for iteration in range(iterations):
+            frame = compress(encoded)
+        elapsed = time.time() - start
+        results[name] = {
+            'bytes': len(encoded),
+            'compressed_bytes': len(frame),
+            'ratio': len(frame) / len(encoded),
+            'compress_ms': elapsed / iterations * 1000
+        }
+    _compression['threshold'] = None
+    return results
+
+
+def benchmark_fanout(client_counts, iterations):
+    """
+    Measures how long it takes to broadcast the full panel of each channel
+    to every connected client, for each number of clients
+    """
+    data = dict((name, channel.fetch()) for name, channel in channels.items())
+    results = {}
+    for count in client_counts:
+        server = socketio.server = BenchmarkServer(count)
+        results[count] = {}
+        for name, channel in channels.items():
+            durations = []
+            sent = 0
+            for iteration in range(iterations):
+                start = time.time()
+                channel.publish_html(data[name])
+                durations.append(time.time() - start)
+                sent += server.drain()
+            results[count][name] = {
+                'broadcast_ms': summarize(durations),
+                'per_client_us': (
+                    sum(durations) / iterations / count * 1000000),
+                'bytes_per_broadcast': sent // iterations
+            }
+    socketio.server = None
+    return results
+
+
+def main():
+    """Starts the stand-ins, runs every benchmark and writes the results"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--render-iterations', type=int, default=200)
+    parser.add_argument('--clients', type=int, nargs='+',
+                        default=[1, 100, 1000])
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every upstream response')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='up to this many extra seconds per response')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='fraction of upstream responses that fail')
+    parser.add_argument('--sessions', type=int, default=2,
+                        help='Plex sessions playing, 0 for recently released')
+    parser.add_argument('--library-size', type=int, default=2000)
+    parser.add_argument('--interfaces', type=int, default=2)
+    parser.add_argument('--services', type=int, default=10)
+    parser.add_argument('--volumes', type=int, default=4)
+    parser.add_argument('--streaming', action='store_true',
+                        help='sample pfSense continuously')
+    parser.add_argument('--plex-notifications', action='store_true',
+                        help='follow the Plex notification feed')
+    parser.add_argument('--output', help='file to write, default stdout')
+    options = parser.parse_args()
+
+    faults = FaultInjector(
+        options.latency, options.jitter, options.failure_rate)
+    upstreams, base_url = start_upstreams(
+        faults, sessions=options.sessions, library_size=options.library_size,
+        volumes=options.volumes)
+    ssh_server, ssh_port = start_ssh_server(faults)
+
+    # Injected failures would prevent the modules from starting
+    faults.failure_rate = 0
+    socketio.server = BenchmarkServer(0)
+    with app.test_request_context('/'):
+        startup = benchmark_startup(
+            create_modules(options, base_url, ssh_port))
+        faults.failure_rate = options.failure_rate
+        results = {
+            'commit': get_commit(),
+            'timestamp': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'settings': vars(options),
+            'startup_ms': startup,
+            'refresh': benchmark_refresh(options.iterations),
+            'render': benchmark_render(options.render_iterations),
+            'compression': benchmark_compression(options.iterations),
+            'fanout': benchmark_fanout(options.clients, options.iterations),
+            'upstreams': faults.get_stats()
+        }
+
+    upstreams.stop()
+    ssh_server.kill()
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
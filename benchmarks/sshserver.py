@@ -0,0 +1,117 @@
+"""
+Contains the local stand-in for the pfSense SSH server, answering the vnstat
+and ping commands run by status.functions.PfSense with canned output
+"""
+
+import socket
+
+import gevent
+import paramiko
+
+# vnstat -i <interface> -tr
+_TRAFFIC_OUTPUT = (
+    '15 packets sampled in 5 seconds\n'
+    'Traffic average for {interface}\n'
+    '\n'
+    '      rx        12.34 Mbit/s          1234 packets/s\n'
+    '      tx         1.23 kbit/s           123 packets/s\n'
+    '\n')
+
+# ping -S <ip> -t 5 <host>
+_PING_OUTPUT = (
+    'PING {host} ({host}): 56 data bytes\n'
+    '64 bytes from {host}: icmp_seq=0 ttl=57 time=12.345 ms\n'
+    '\n'
+    '--- {host} ping statistics ---\n'
+    '5 packets transmitted, 5 packets received, 0.0% packet loss\n'
+    'round-trip min/avg/max/stddev = 10.123/12.345/15.678/1.234 ms\n')
+
+# vnstat -l -i <interface>, repeated every second
+_LIVE_LINE = (
+    '   rx:    12.34 Mbit/s  1234 p/s          tx:     1.23 Mbit/s   123 p/s'
+    '\r')
+
+# ping -S <ip> <host>, repeated every second
+_PING_LINE = '64 bytes from {host}: icmp_seq={sequence} ttl=57 time=12.345 ms\n'
+
+
+class FakePfSense(paramiko.ServerInterface):
+    """
+    Accepts any password and answers each command on its own channel after
+    the latency of the FaultInjector, exiting with an error instead when a
+    failure is injected
+    """
+
+    def __init__(self, faults):
+        """Initializes the server interface for a single connection"""
+        self._faults = faults
+
+    def check_auth_password(self, username, password):
+        """Accepts every username and password"""
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        """Returns the authentication methods that are allowed"""
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        """Accepts session channels"""
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_FAILED
+
+    def check_channel_exec_request(self, channel, command):
+        """Runs the command in its own greenlet"""
+        gevent.spawn(self.run_command, channel, command.split())
+        return True
+
+    def run_command(self, channel, arguments):
+        """Writes the canned output of the command to the channel"""
+        try:
+            self._faults.delay()
+            if self._faults.should_fail():
+                channel.send_exit_status(1)
+                return
+
+            if arguments[:2] == ['vnstat', '-l']:
+                while not channel.closed:
+                    channel.send(_LIVE_LINE)
+                    gevent.sleep(1)
+            elif arguments[0] == 'vnstat':
+                channel.send(_TRAFFIC_OUTPUT.format(interface=arguments[2]))
+            elif '-t' in arguments:
+                channel.send(_PING_OUTPUT.format(host=arguments[-1]))
+            else:
+                sequence = 0
+                while not channel.closed:
+                    channel.send(_PING_LINE.format(
+                        host=arguments[-1], sequence=sequence))
+                    sequence += 1
+                    gevent.sleep(1)
+            channel.send_exit_status(0)
+        except (EOFError, socket.error):
+            pass
+        finally:
+            channel.close()
+
+
+def start_ssh_server(faults):
+    """
+    Starts accepting SSH connections on a free local port, returning the
+    greenlet serving them and the port
+    """
+    host_key = paramiko.RSAKey.generate(1024)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+
+    def serve():
+        """Starts an SSH transport for every accepted connection"""
+        while True:
+            connection, address = listener.accept()
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(host_key)
+            gevent.spawn(transport.start_server, server=FakePfSense(faults))
+
+    return gevent.spawn(serve), listener.getsockname()[1]
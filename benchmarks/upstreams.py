@@ -0,0 +1,311 @@
+"""
+Contains the local stand-ins for the HTTP servers that the modules talk to:
+Plex (including its notification feed), Forecast.io, FreeNAS and the
+monitored services
+"""
+
+import json
+import random
+import re
+import time
+
+import gevent
+from gevent.pywsgi import WSGIServer
+from geventwebsocket.handler import WebSocketHandler
+from requests.compat import unquote
+
+
+class FaultInjector:
+    """
+    Delays every response by latency seconds, plus up to jitter seconds, and
+    fails the given fraction of them
+    """
+
+    def __init__(self, latency=0, jitter=0, failure_rate=0):
+        """Initializes the injector with the provided settings"""
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.failures = 0
+
+    def delay(self):
+        """Waits for the configured latency"""
+        self.requests += 1
+        duration = self.latency + random.uniform(0, self.jitter)
+        if duration:
+            gevent.sleep(duration)
+
+    def should_fail(self):
+        """Returns whether the current response should fail"""
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            return True
+        return False
+
+    def get_stats(self):
+        """Returns the number of requests and injected failures"""
+        return {'requests': self.requests, 'failures': self.failures}
+
+
+class Upstreams:
+    """
+    A WSGI application serving canned responses for every upstream API used
+    by status.functions, with a FaultInjector applied to each request
+    """
+    _NEWEST_URL = re.compile(r'^/library/sections/(?P<section>\d+)/newest$')
+    _ALL_URL = re.compile(r'^/library/sections/(?P<section>\d+)/all$')
+    _METADATA_URL = re.compile(r'^/library/metadata/(?P<key>\d+)$')
+    _DATASETS_URL = re.compile(
+        r'^/api/v1.0/storage/volume/(?P<volume>[^/]+)/datasets/$')
+
+    def __init__(
+            self, faults, sessions=2, sections=2, library_size=2000,
+            volumes=4, event_interval=1):
+        """
+        Initializes the stand-ins. Plex has sessions playing videos and
+        sections each holding library_size videos, FreeNAS has volumes, and
+        a playing notification is pushed every event_interval seconds
+        """
+        self.faults = faults
+        self._sessions = sessions
+        self._sections = sections
+        self._library_size = library_size
+        self._volumes = volumes
+        self._event_interval = event_interval
+        self._started = time.time()
+        self._routes = [
+            ('/users/sign_in.xml', self.sign_in),
+            ('/status/sessions', self.sessions),
+            ('/library/sections', self.sections),
+            (Upstreams._NEWEST_URL, self.newest),
+            (Upstreams._ALL_URL, self.all),
+            (Upstreams._METADATA_URL, self.metadata),
+            ('/:/websockets/notifications', self.notifications),
+            ('/api/v1.0/storage/volume/', self.storage_volumes),
+            (Upstreams._DATASETS_URL, self.storage_datasets),
+            (re.compile(r'^/forecast/'), self.forecast),
+            ('/', self.service)
+        ]
+
+    def __call__(self, environ, start_response):
+        """Routes the request to its stand-in after injecting faults"""
+        path = environ['PATH_INFO']
+        for route, handler in self._routes:
+            if hasattr(route, 'match'):
+                match = route.match(path)
+            else:
+                match = route == path
+            if match:
+                break
+        else:
+            start_response('404 Not Found', [])
+            return ['']
+
+        if handler == self.notifications:
+            return handler(environ, start_response)
+
+        self.faults.delay()
+        if self.faults.should_fail():
+            start_response('500 Internal Server Error', [])
+            return ['injected failure']
+
+        query = dict(
+            pair.split('=', 1) for pair in
+            environ.get('QUERY_STRING', '').split('&') if '=' in pair)
+        content_type, body = handler(
+            match if hasattr(match, 'group') else None, query)
+        start_response('200 OK', [
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(body)))])
+        return [body]
+
+    def get_offset(self, duration):
+        """Returns the playback position of a session that loops forever"""
+        return int((time.time() - self._started) * 1000) % duration
+
+    def sign_in(self, match, query):
+        """Returns a Plex authentication token"""
+        return 'text/xml', '<user authenticationToken="benchmark"/>'
+
+    def sessions(self, match, query):
+        """Returns the Plex sessions, one per configured playing video"""
+        videos = []
+        for index in range(self._sessions):
+            videos.append(
+                '<Video key="/library/metadata/{index}" ratingKey="{index}" '
+                'sessionKey="{session}" type="movie" duration="7200000" '
+                'viewOffset="{offset}"><Media><Part/></Media>'
+                '<User title="user{index}"/>'
+                '<Player title="Player {index}" state="playing"/>'
+                '</Video>'.format(
+                    index=index, session=index + 1,
+                    offset=self.get_offset(7200000)))
+        return 'text/xml', '<MediaContainer size="{}">{}</MediaContainer>'.format(
+            len(videos), ''.join(videos))
+
+    def sections(self, match, query):
+        """Returns the Plex library sections"""
+        return 'text/xml', '<MediaContainer>{}</MediaContainer>'.format(''.join(
+            '<Directory key="{}" type="movie" title="Section {}"/>'.format(
+                section, section)
+            for section in range(1, self._sections + 1)))
+
+    def get_library(self, section):
+        """
+        Returns the videos of a Plex section ordered by release date, newest
+        first, as (key, added_at) pairs. Videos weren't added in the order
+        they were released, so the two orders are interleaved
+        """
+        newest = int(self._started)
+        return [
+            (section * 1000000 + index,
+             newest - (index * 7919 % self._library_size) * 60)
+            for index in range(self._library_size)]
+
+    def list_videos(self, videos, query):
+        """
+        Returns the MediaContainer of the videos, honouring the container
+        start and size so that windowed requests can be measured
+        """
+        start = int(query.get('X-Plex-Container-Start', 0))
+        size = int(query.get('X-Plex-Container-Size', self._library_size))
+        return 'text/xml', (
+            '<MediaContainer totalSize="{}">{}</MediaContainer>'.format(
+                len(videos), ''.join(
+                    '<Video key="/library/metadata/{key}" ratingKey="{key}" '
+                    'type="movie" title="Video {key}" addedAt="{added_at}" '
+                    'summary="{summary}"><Media><Part/></Media>'
+                    '</Video>'.format(
+                        key=key, added_at=added_at,
+                        summary='A benchmark video. ' * 20)
+                    for key, added_at in videos[start:start + size])))
+
+    def newest(self, match, query):
+        """Returns the videos in a Plex section by release date"""
+        return self.list_videos(
+            self.get_library(int(match.group('section'))), query)
+
+    def all(self, match, query):
+        """
+        Returns every video in a Plex section, sorted by when it was added
+        when asked to
+        """
+        videos = self.get_library(int(match.group('section')))
+        sort = unquote(query.get('sort', ''))
+        if sort.startswith('addedAt'):
+            videos.sort(
+                key=lambda video: video[1], reverse=sort.endswith(':desc'))
+        return self.list_videos(videos, query)
+
+    def metadata(self, match, query):
+        """Returns the metadata of a Plex video"""
+        key = int(match.group('key'))
+        if key % 2:
+            video = (
+                '<Video key="/library/metadata/{key}" ratingKey="{key}" '
+                'type="episode" title="Episode {key}" '
+                'grandparentTitle="Show {key}" parentIndex="1" index="{key}" '
+                'summary="An episode." duration="2700000" '
+                'thumb="/library/metadata/{key}/thumb" '
+                'grandparentThumb="/library/metadata/{key}/show"/>')
+        else:
+            video = (
+                '<Video key="/library/metadata/{key}" ratingKey="{key}" '
+                'type="movie" title="Movie {key}" summary="{summary}" '
+                'duration="7200000" thumb="/library/metadata/{key}/thumb"/>')
+        return 'text/xml', '<MediaContainer>{}</MediaContainer>'.format(
+            video.format(key=key, summary='A benchmark movie. ' * 60))
+
+    def notifications(self, environ, start_response):
+        """
+        Pushes a playing notification for every session over the websocket
+        until the client disconnects
+        """
+        websocket = environ.get('wsgi.websocket')
+        if websocket is None:
+            start_response('400 Bad Request', [])
+            return ['expected a websocket']
+        while not websocket.closed:
+            gevent.sleep(self._event_interval)
+            websocket.send(json.dumps({'NotificationContainer': {
+                'type': 'playing',
+                'size': self._sessions,
+                'PlaySessionStateNotification': [{
+                    'sessionKey': str(index + 1),
+                    'ratingKey': str(index),
+                    'viewOffset': self.get_offset(7200000),
+                    'state': 'playing'
+                } for index in range(self._sessions)]
+            }}))
+        return []
+
+    def forecast(self, match, query):
+        """Returns a Forecast.io forecast"""
+        now = int(time.time())
+        return 'application/json', json.dumps({
+            'latitude': 0,
+            'longitude': 0,
+            'timezone': 'UTC',
+            'offset': 0,
+            'currently': {
+                'time': now, 'summary': 'Clear', 'icon': 'clear-day',
+                'temperature': 71.3, 'windSpeed': 4.2, 'windBearing': 210
+            },
+            'minutely': {
+                'summary': 'Clear for the hour.', 'icon': 'clear-day',
+                'data': [{'time': now + minute * 60}
+                         for minute in range(60)]
+            },
+            'hourly': {
+                'summary': 'Clear throughout the day.', 'icon': 'clear-day',
+                'data': [{'time': now + hour * 3600, 'temperature': 70}
+                         for hour in range(48)]
+            },
+            'daily': {
+                'summary': 'No precipitation this week.', 'icon': 'clear-day',
+                'data': [{
+                    'time': now + day * 86400,
+                    'sunriseTime': now - 3600 + day * 86400,
+                    'sunsetTime': now + 3600 + day * 86400
+                } for day in range(8)]
+            },
+            'flags': {'units': 'us'}
+        })
+
+    def storage_volumes(self, match, query):
+        """Returns the FreeNAS volumes"""
+        return 'application/json', json.dumps([{
+            'vol_name': 'volume{}'.format(index),
+            'used_pct': '{}%'.format(10 * (index + 1)),
+            'avail': 1000000000000 * (10 - index),
+            'used': 1000000000000 * (index + 1)
+        } for index in range(self._volumes)])
+
+    def storage_datasets(self, match, query):
+        """Returns a page of the datasets of a FreeNAS volume"""
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 20))
+        return 'application/json', json.dumps([{
+            'name': '{}/dataset{}'.format(match.group('volume'), index),
+            'mountpoint': '/mnt/{}/dataset{}'.format(
+                match.group('volume'), index),
+            'avail': 1000000000 * (index % 10 + 1),
+            'used': 1000000000 * (10 - index % 10)
+        } for index in range(offset, min(offset + limit, 1000))])
+
+    def service(self, match, query):
+        """Responds to a service check"""
+        return 'text/plain', 'OK'
+
+
+def start_upstreams(faults, **kwargs):
+    """
+    Starts serving the stand-ins on a free local port, returning the server
+    and its base url
+    """
+    server = WSGIServer(
+        ('127.0.0.1', 0), Upstreams(faults, **kwargs),
+        handler_class=WebSocketHandler, log=None)
+    server.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
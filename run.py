@@ -2,18 +2,50 @@
 Launcher for the status package.
 This has to be run from one level above the package
 """
+import argparse
 import json
+import logging
 import os
+import time
+
+import gevent
 
 from status import app, socketio
 import status
-from status.functions import ForecastIO, PfSense, Plex, Services, Freenas
+from status.functions import (ForecastIO, PfSense, Plex, Services, Freenas,
+                              start_frontend, start_poller)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    """Parses the command line arguments"""
+    parser = argparse.ArgumentParser(description='Network Status Page')
+    parser.add_argument(
+        '--role', choices=['standalone', 'poller', 'frontend'],
+        default='standalone',
+        help='run everything in one process (the default), only poll the '
+             'upstream servers, or only serve clients from a poller')
+    parser.add_argument(
+        '--port', type=int, help='port to serve on instead of the configured '
+                                 'one, for running several front ends')
+    parser.add_argument(
+        '--bus', help='path of the Unix socket connecting the poller and '
+                      'front ends')
+    return parser.parse_args()
 
 
 def main():
     """
-    Loads the configuration from JSON and initializes the necessary modules
+    Loads the configuration from JSON and starts initializing the necessary
+    modules in the background while the server starts.
+
+    A poller only owns the modules and publishes their channels over the
+    message bus, while front ends only serve clients with what the poller
+    publishes, so any number of front ends can share one poller
     """
+    args = parse_args()
+    start = time.time()
     try:
         path = os.path.dirname(os.path.realpath(__file__))
         config_path = os.path.join(path, 'config.json')
@@ -31,15 +63,67 @@ def main():
         exit('Missing configuration in config.json')
 
     status.config = config
-    status.modules['plex'] = Plex(**status.config['plex'])
-    status.modules['forecast'] = ForecastIO(**status.config['forecast'])
-    status.modules['pfsense'] = PfSense(**status.config['pfsense'])
-    status.modules['services'] = Services(status.config['services'])
-    status.modules['freenas'] = Freenas(**status.config['freenas'])
+    bus_config = dict(status.config.get('bus', {}), role=args.role)
+    if args.bus:
+        bus_config['path'] = args.bus
+    status.bus.configure(**bus_config)
+    status.http_pool.configure(**status.config.get('http', {}))
+    status.image_cache.configure(**dict(
+        {'directory': os.path.join(path, 'cache', 'images')},
+        **status.config.get('image_cache', {})))
+    status.history.configure(**dict(
+        {'path': os.path.join(path, 'cache', 'history.sqlite3')},
+        **status.config.get('history', {})))
+    status.module_loader.configure(**status.config.get('startup', {}))
+    status.breakers.configure(**status.config.get('circuit_breakers', {}))
+    logger.info('Loaded configuration in %.2fs', time.time() - start)
+
+    if args.role == 'frontend':
+        # Front ends only need Plex to proxy its artwork
+        status.module_loader.load(
+            'plex', lambda: Plex(**dict(
+                status.config['plex'], notifications=False)))
+        start_frontend()
+    else:
+        load_modules(path)
+
+    if args.role == 'poller':
+        start_poller()
+        logger.info('Polling after %.2fs', time.time() - start)
+        gevent.wait()
+        return
+
+    app_config = dict(status.config['app'])
+    if args.port:
+        app_config['port'] = args.port
+    logger.info('Starting server after %.2fs', time.time() - start)
+    socketio.run(app, **app_config)
+
 
-    socketio.run(app, **status.config['app'])
+def load_modules(path):
+    """Starts loading every module in the background"""
+    status.module_loader.load(
+        'plex', lambda: Plex(**dict(
+            {'recently_released_path': os.path.join(
+                path, 'cache', 'recently_released.json')},
+            **status.config['plex'])))
+    status.module_loader.load(
+        'forecast', lambda: ForecastIO(**dict(
+            {'cache_path': os.path.join(path, 'cache', 'forecast.json')},
+            **status.config['forecast'])))
+    status.module_loader.load(
+        'pfsense', lambda: PfSense(**status.config['pfsense']))
+    status.module_loader.load(
+        'services', lambda: Services(
+            status.config['services'],
+            **status.config.get('service_checks', {})))
+    status.module_loader.load(
+        'freenas', lambda: Freenas(**status.config['freenas']))
 
 if __name__ == '__main__':
     from gevent import monkey
     monkey.patch_all()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     main()
@@ -2,10 +2,31 @@ from flask import Flask
 from flask_util_js import FlaskUtilJs
 from flask_socketio import SocketIO
 
+from status.audience import Audience
+from status.bus import MessageBus
+from status.channels import SnapshotStore
+from status.connections import SessionPool
+from status.history import HistoryStore
+from status.imagecache import ImageCache
+from status.metrics import MetricsRegistry
+from status.resilience import CircuitBreakers
+from status.scheduler import Scheduler
+from status.startup import ModuleLoader
+
 app = Flask(__name__)
 fujs = FlaskUtilJs(app)
 socketio = SocketIO(app)
+http_pool = SessionPool()
+snapshots = SnapshotStore()
+image_cache = ImageCache()
+scheduler = Scheduler()
+audience = Audience()
+breakers = CircuitBreakers()
+metrics = MetricsRegistry()
+history = HistoryStore()
+bus = MessageBus()
 config = {}
 modules = {}
+module_loader = ModuleLoader(modules)
 
 import status.views
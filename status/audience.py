@@ -0,0 +1,71 @@
+"""
+Contains the tracker of which SocketIO clients are watching which channels
+"""
+
+
+class Audience:
+    """
+    Keeps track of the connected SocketIO clients and the channels each of
+    them is watching, so that channels nobody is watching can stop polling
+    """
+
+    def __init__(self):
+        """Initializes an audience without any clients"""
+        self._clients = {}
+
+    def watch(self, client, channels):
+        """
+        Marks the client as watching the channels and returns the channels
+        that had no watchers before
+        """
+        watched = self._clients.setdefault(client, set())
+        started = [
+            channel for channel in channels
+            if channel not in watched and not self.get_watchers(channel)]
+        watched.update(channels)
+        return started
+
+    def unwatch(self, client, channels):
+        """
+        Marks the client as no longer watching the channels and returns the
+        channels that are left without any watchers
+        """
+        watched = self._clients.get(client, set())
+        stopped = [channel for channel in channels if channel in watched]
+        watched.difference_update(channels)
+        return [
+            channel for channel in stopped if not self.get_watchers(channel)]
+
+    def disconnect(self, client):
+        """
+        Forgets the client and returns the channels that are left without
+        any watchers
+        """
+        channels = list(self._clients.get(client, set()))
+        stopped = self.unwatch(client, channels)
+        self._clients.pop(client, None)
+        return stopped
+
+    def get_watched(self, client):
+        """Returns the channels the client is watching"""
+        return set(self._clients.get(client, set()))
+
+    def get_watchers(self, channel):
+        """Returns the number of clients watching the channel"""
+        return sum(
+            1 for watched in self._clients.values() if channel in watched)
+
+    def get_client_count(self):
+        """Returns the number of connected clients"""
+        return len(self._clients)
+
+    def get_stats(self):
+        """Returns the number of clients and the watchers of each channel"""
+        channels = set()
+        for watched in self._clients.values():
+            channels.update(watched)
+        return {
+            'clients': self.get_client_count(),
+            'watchers': dict(
+                (channel, self.get_watchers(channel)) for channel in channels)
+        }
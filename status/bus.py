@@ -0,0 +1,191 @@
+"""
+Contains the message bus connecting the poller process, which owns the
+modules, to the front end processes serving the SocketIO clients
+"""
+
+import itertools
+import json
+import logging
+import os
+import socket
+
+import gevent
+from gevent.queue import Full, Queue
+from gevent.server import StreamServer
+
+logger = logging.getLogger(__name__)
+
+
+def encode(message):
+    """Encodes a message as a single line of JSON"""
+    return (json.dumps(message, default=str) + '\n').encode('utf-8')
+
+
+def read_messages(connection):
+    """Yields every message read from the connection until it is closed"""
+    lines = connection.makefile('r')
+    while True:
+        line = lines.readline()
+        if not line:
+            return
+        yield json.loads(line)
+
+
+class Subscriber:
+    """
+    A front end connected to the poller. Messages are queued and written by
+    a greenlet of its own so that a slow front end never holds up the others
+    """
+
+    def __init__(self, subscriber_id, connection, max_queue):
+        """Initializes the subscriber with an empty queue"""
+        self.id = subscriber_id
+        self.connection = connection
+        self.queue = Queue(max_queue)
+
+    def send(self, line):
+        """
+        Queues an encoded message for the front end. A front end that has
+        fallen max_queue messages behind is disconnected, after which it
+        reconnects and starts over from the latest snapshots
+        """
+        try:
+            self.queue.put_nowait(line)
+        except Full:
+            logger.warning(
+                'Disconnecting front end %s, it fell behind', self.id)
+            self.connection.close()
+
+    def send_message(self, message):
+        """Queues a message for the front end"""
+        self.send(encode(message))
+
+    def write_forever(self):
+        """Writes the queued messages to the front end"""
+        while True:
+            self.connection.sendall(self.queue.get())
+
+
+class MessageBus:
+    """
+    A publish/subscribe bus over a Unix socket. The poller serves the socket
+    and publishes to every front end connected to it, while each front end
+    subscribes to the poller and sends its own messages back. Messages are
+    dictionaries sent as lines of JSON. In the standalone role the bus is
+    unused
+    """
+    STANDALONE = 'standalone'
+    POLLER = 'poller'
+    FRONTEND = 'frontend'
+
+    def __init__(self, **kwargs):
+        """Initializes the bus with the default settings"""
+        self.configure(**kwargs)
+
+    def configure(
+            self, role=STANDALONE, path='status.sock', max_queue=1000,
+            reconnect_delay=1, **kwargs):
+        """Sets the role of this process and the path of the socket"""
+        self.role = role
+        self._path = path
+        self._max_queue = max_queue
+        self._reconnect_delay = reconnect_delay
+        self._subscribers = {}
+        self._ids = itertools.count(1)
+        self._connection = None
+        self.published = 0
+        self.received = 0
+
+    def serve(self, on_connect, on_message, on_disconnect):
+        """
+        Starts accepting front ends on the socket. on_connect is called with
+        each new Subscriber, on_message with the id of the subscriber and each
+        message it sends and on_disconnect with its id once it is gone
+        """
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self._path)
+        listener.listen(64)
+
+        def handle(connection, address):
+            """Serves a single front end until it disconnects"""
+            subscriber = Subscriber(
+                next(self._ids), connection, self._max_queue)
+            self._subscribers[subscriber.id] = subscriber
+            writer = gevent.spawn(subscriber.write_forever)
+            try:
+                on_connect(subscriber)
+                for message in read_messages(connection):
+                    self.received += 1
+                    on_message(subscriber.id, message)
+            except (socket.error, ValueError):
+                pass
+            finally:
+                del self._subscribers[subscriber.id]
+                writer.kill()
+                connection.close()
+                on_disconnect(subscriber.id)
+
+        StreamServer(listener, handle).start()
+
+    def publish(self, message):
+        """Sends the message to every connected front end"""
+        line = encode(message)
+        self.published += 1
+        for subscriber in list(self._subscribers.values()):
+            subscriber.send(line)
+
+    def send_to(self, subscriber_id, message):
+        """Sends the message to a single front end, if it is connected"""
+        subscriber = self._subscribers.get(subscriber_id)
+        if subscriber is not None:
+            subscriber.send_message(message)
+
+    def subscribe(self, on_connect, on_message):
+        """
+        Keeps a connection to the poller open in the background,
+        reconnecting whenever it drops. on_connect is called every time the
+        connection is opened and on_message with each message received
+        """
+        def receive_forever():
+            """Receives messages from the poller"""
+            while True:
+                connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    connection.connect(self._path)
+                    self._connection = connection
+                    on_connect()
+                    for message in read_messages(connection):
+                        self.received += 1
+                        on_message(message)
+                except (socket.error, ValueError):
+                    pass
+                finally:
+                    self._connection = None
+                    connection.close()
+                gevent.sleep(self._reconnect_delay)
+
+        gevent.spawn(receive_forever)
+
+    def send(self, message):
+        """
+        Sends the message from a front end to the poller. Messages sent while
+        disconnected are dropped, so they must be resent on reconnecting
+        """
+        if self._connection is None:
+            return
+        try:
+            self._connection.sendall(encode(message))
+        except socket.error:
+            pass
+
+    def get_stats(self):
+        """Returns the role of the process and the number of messages"""
+        return {
+            'role': self.role,
+            'subscribers': len(self._subscribers),
+            'connected': self._connection is not None,
+            'published': self.published,
+            'received': self.received
+        }
@@ -0,0 +1,271 @@
+"""
+Contains the SocketIO channels and the snapshot store that holds the last
+rendered content of each of them
+"""
+
+from collections import OrderedDict
+import copy
+import hashlib
+import json
+import time
+
+
+def fingerprint(data):
+    """Returns a hash of the JSON representation of data"""
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+
+
+class SnapshotStore:
+    """
+    Holds the last rendered HTML for each SocketIO channel along with its
+    version and the time it was rendered so that clients can be served
+    without communicating with any of the upstream servers
+    """
+
+    def __init__(self):
+        """Initializes an empty snapshot store"""
+        self._snapshots = {}
+
+    def update(self, channel, data=None, render=None):
+        """
+        Stores data as the latest snapshot for the channel and returns the
+        new snapshot. If render is provided instead of data, it is called to
+        produce the data the first time the snapshot is requested
+        """
+        previous = self._snapshots.get(channel)
+        snapshot = {
+            'data': data,
+            'version': previous['version'] + 1 if previous else 1,
+            'timestamp': time.time()
+        }
+        if data is None:
+            snapshot['render'] = render
+        self._snapshots[channel] = snapshot
+        return snapshot
+
+    def put(self, channel, snapshot):
+        """
+        Replaces the latest snapshot for the channel with one taken from
+        another snapshot store, keeping its version
+        """
+        self._snapshots[channel] = snapshot
+
+    def get(self, channel):
+        """Returns the latest snapshot for the channel, or None"""
+        snapshot = self._snapshots.get(channel)
+        if snapshot and snapshot['data'] is None:
+            render = snapshot.pop('render', None)
+            if render:
+                snapshot['data'] = render()
+        return snapshot
+
+    def mark_stale(self, channel, since):
+        """
+        Marks the latest snapshot for the channel as stale since the provided
+        time, or as fresh again if since is None
+        """
+        snapshot = self._snapshots.get(channel)
+        if snapshot:
+            snapshot['stale_since'] = since
+
+    def get_version(self, channel):
+        """Returns the version of the latest snapshot for the channel"""
+        snapshot = self._snapshots.get(channel)
+        return snapshot['version'] if snapshot else 0
+
+    def get_channels(self):
+        """Returns the list of channels that have a snapshot"""
+        return list(self._snapshots.keys())
+
+
+class Channel:
+    """
+    A SocketIO channel that fetches its source data from a module and only
+    renders and emits it when the fingerprint of that data has changed.
+
+    When delta updates are enabled and the channel's data is made up of
+    records identified by key, changes that only affect the patchable fields
+    of those records are sent as a '<name>_patch' event containing just the
+    changed fields instead of re-rendering the whole panel.
+
+    The HTML rendered for the last few fingerprints is kept, so data that
+    returns to an earlier state is never rendered twice
+    """
+    RENDERED_SIZE = 8
+
+    def __init__(
+            self, name, fetch, render, store, emit, records=None, key=None,
+            fields=()):
+        """
+        Initializes the channel. fetch returns the source data, render turns
+        that data into HTML and emit sends an event to all clients. records
+        returns the list of patchable records in the data (or None when the
+        data can't be patched), key is the field identifying each record and
+        fields are the record fields that can be patched on the client
+        """
+        self.name = name
+        self._fetch = fetch
+        self._render = render
+        self._store = store
+        self._emit = emit
+        self._records = records or (lambda data: data)
+        self._key = key
+        self._fields = fields
+        self._fingerprint = None
+        self._structure = None
+        self._values = None
+        self._rendered = OrderedDict()
+        self.delta_updates = False
+        self.stale_since = None
+        self.renders_performed = 0
+        self.renders_reused = 0
+        self.renders_skipped = 0
+        self.patches_sent = 0
+
+    def fetch(self):
+        """Returns the source data of the channel"""
+        return self._fetch()
+
+    def refresh(self, data=None):
+        """
+        Fetches the source data, unless it is provided, and publishes it if
+        it has changed since the last refresh. Returns whether anything was
+        published
+        """
+        if data is None:
+            data = self._fetch()
+        self.mark_fresh()
+        digest = fingerprint(data)
+        if digest == self._fingerprint:
+            self.renders_skipped += 1
+            return False
+        self._fingerprint = digest
+
+        structure, values = self.split_records(data)
+        if (self.delta_updates and structure is not None and
+                structure == self._structure):
+            self.publish_patch(data, values, digest)
+        else:
+            self.publish_html(data, digest)
+        self._structure = structure
+        self._values = values
+        return True
+
+    def mark_stale(self):
+        """
+        Tells all clients that the published data is stale because it could
+        not be refreshed. The data itself stays published
+        """
+        if self.stale_since is None:
+            self.stale_since = time.time()
+            self._store.mark_stale(self.name, self.stale_since)
+            self._emit('stale', {
+                'channel': self.name, 'since': self.stale_since})
+
+    def mark_fresh(self):
+        """Tells all clients that the published data is no longer stale"""
+        if self.stale_since is not None:
+            self.stale_since = None
+            self._store.mark_stale(self.name, None)
+            self._emit('stale', {'channel': self.name, 'since': None})
+
+    def publish_placeholder(self, html):
+        """
+        Publishes html in place of the channel's data, such as while its
+        module is loading. Returns whether anything was published
+        """
+        digest = fingerprint(html)
+        if digest == self._fingerprint:
+            self.renders_skipped += 1
+            return False
+        self._fingerprint = digest
+        self._structure = None
+        self._values = None
+        snapshot = self._store.update(self.name, html)
+        self._emit(self.name, {'data': html, 'version': snapshot['version']})
+        return True
+
+    def split_records(self, data):
+        """
+        Splits the data into the fingerprint of everything that can't be
+        patched and a dictionary of the patchable field values of each record
+        """
+        if not self._key:
+            return None, None
+        records = self._records(data)
+        if records is None:
+            return None, None
+
+        static = [
+            dict((field, value) for field, value in record.items()
+                 if field not in self._fields)
+            for record in records]
+        values = dict(
+            (str(record[self._key]),
+             dict((field, record.get(field)) for field in self._fields))
+            for record in records)
+        return fingerprint(static), values
+
+    def render_uncached(self, data):
+        """Renders the data into HTML"""
+        self.renders_performed += 1
+        return self._render(data)
+
+    def render(self, data, digest=None):
+        """
+        Returns the HTML for the data, reusing the HTML rendered earlier for
+        data with the same fingerprint
+        """
+        if digest is None:
+            digest = fingerprint(data)
+        if digest in self._rendered:
+            self.renders_reused += 1
+            html = self._rendered.pop(digest)
+        else:
+            html = self.render_uncached(data)
+        self._rendered[digest] = html
+        if len(self._rendered) > Channel.RENDERED_SIZE:
+            self._rendered.popitem(last=False)
+        return html
+
+    def publish_html(self, data, digest=None):
+        """Renders the data and sends the full HTML to all clients"""
+        html = self.render(data, digest)
+        snapshot = self._store.update(self.name, html)
+        self._emit(self.name, {'data': html, 'version': snapshot['version']})
+
+    def publish_patch(self, data, values, digest=None):
+        """
+        Sends the fields that changed since the last refresh to all clients.
+        The HTML snapshot is only rendered when a client needs the full panel
+        """
+        patches = {}
+        for key, fields in values.items():
+            changed = dict(
+                (field, value) for field, value in fields.items()
+                if self._values[key].get(field) != value)
+            if changed:
+                patches[key] = changed
+
+        base = self._store.get_version(self.name)
+        data = copy.deepcopy(data)
+        snapshot = self._store.update(
+            self.name, render=lambda: self.render(data, digest))
+        self.patches_sent += 1
+        self._emit('{}_patch'.format(self.name), {
+            'patches': patches,
+            'base': base,
+            'version': snapshot['version']
+        })
+
+    def get_stats(self):
+        """Returns the render counters for the channel"""
+        return {
+            'renders_performed': self.renders_performed,
+            'renders_skipped': self.renders_skipped,
+            'renders_reused': self.renders_reused,
+            'patches_sent': self.patches_sent,
+            'stale_since': self.stale_since
+        }
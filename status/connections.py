@@ -0,0 +1,149 @@
+"""
+Contains the shared HTTP connection pool used by all of the modules to
+communicate with their upstream servers
+"""
+
+from gevent.lock import BoundedSemaphore
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import urlparse
+
+
+def discard_response(response):
+    """
+    Closes a streamed response that may not have been read completely,
+    along with its connection. Returning the connection to the pool would
+    leave the unread rest of the body to be read as the next response
+    """
+    response.raw.close()
+    connection = getattr(response.raw, '_connection', None)
+    if connection is not None:
+        connection.close()
+    response.close()
+
+
+def release_response(response, max_drain=64 * 1024):
+    """
+    Closes a streamed response that may not have been read completely,
+    reading the rest of its body first so that its connection can go back
+    to the pool. Responses with more than max_drain bytes left are
+    discarded along with their connection instead
+    """
+    drained = 0
+    while drained <= max_drain:
+        chunk = response.raw.read(8192, decode_content=False)
+        if not chunk:
+            response.close()
+            return
+        drained += len(chunk)
+    discard_response(response)
+
+
+class SessionPool:
+    """
+    Wraps a requests Session with keep-alive connection pools so that every
+    module reuses its TCP/TLS connections instead of handshaking on each call
+    """
+
+    def __init__(self, **kwargs):
+        """Initializes the session pool with the default settings"""
+        self.configure(**kwargs)
+
+    def configure(
+            self, max_hosts=10, max_connections_per_host=4,
+            connect_timeout=3.05, read_timeout=10, pool_timeout=None,
+            **kwargs):
+        """
+        (Re)creates the underlying session with the provided limits. At most
+        max_connections_per_host requests are made to each host at once, and
+        a request waits up to pool_timeout seconds (connect_timeout by
+        default) for one of them to finish before failing with a
+        ConnectTimeout. A streamed response holds its connection until it
+        is closed, so every streamed response must be closed
+        """
+        self._timeout = (connect_timeout, read_timeout)
+        self._max_connections_per_host = max_connections_per_host
+        self._pool_timeout = (
+            connect_timeout if pool_timeout is None else pool_timeout)
+        self._slots = {}
+        self._adapter = HTTPAdapter(
+            pool_connections=max_hosts,
+            pool_maxsize=max_connections_per_host,
+            pool_block=False
+        )
+        self._session = requests.Session()
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+
+    def get_slots(self, url):
+        """Returns the semaphore limiting the connections to url's host"""
+        parsed = urlparse(url)
+        host = '{}://{}'.format(parsed.scheme, parsed.netloc)
+        slots = self._slots.get(host)
+        if slots is None:
+            slots = self._slots[host] = BoundedSemaphore(
+                self._max_connections_per_host)
+        return slots
+
+    def request(self, method, url, **kwargs):
+        """
+        Makes a request over a pooled connection once one of the host's
+        connections is free, applying the configured connect/read timeouts
+        unless a timeout is provided. The connection is freed when the
+        request completes, or when a streamed response is closed
+        """
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self._timeout
+        slots = self.get_slots(url)
+        if not slots.acquire(timeout=self._pool_timeout):
+            raise requests.exceptions.ConnectTimeout(
+                'No connection to {} was free within {} seconds'.format(
+                    url, self._pool_timeout))
+        try:
+            response = self._session.request(method, url, **kwargs)
+        except:
+            slots.release()
+            raise
+        if not kwargs.get('stream'):
+            slots.release()
+            return response
+
+        close = response.close
+        released = []
+
+        def close_and_release():
+            """Closes the response and frees its slot the first time"""
+            try:
+                close()
+            finally:
+                if not released:
+                    released.append(True)
+                    slots.release()
+        response.close = close_and_release
+        return response
+
+    def get(self, url, **kwargs):
+        """Makes a GET request over a pooled connection"""
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """Makes a POST request over a pooled connection"""
+        return self.request('POST', url, **kwargs)
+
+    def get_stats(self):
+        """
+        Returns a dictionary containing the number of requests made and
+        connections opened for each host. Every request beyond the number of
+        connections reused an existing connection
+        """
+        stats = {}
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            host = '{}://{}:{}'.format(pool.scheme, pool.host, pool.port)
+            stats[host] = {
+                'requests': pool.num_requests,
+                'connections': pool.num_connections,
+                'reused': max(pool.num_requests - pool.num_connections, 0)
+            }
+        return stats
@@ -0,0 +1,100 @@
+"""
+Contains the cache of the latest Forecast.io forecast, which is saved along
+with the API calls made today so that restarts don't use up the quota
+"""
+
+from datetime import datetime
+import logging
+import time
+
+from status.persistence import read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+
+def get_day():
+    """Returns the current day in UTC, when the Forecast.io quota resets"""
+    return datetime.utcnow().strftime('%Y-%m-%d')
+
+
+class ForecastCache:
+    """
+    Holds the latest forecast response along with the time it was fetched,
+    its ETag and the number of API calls made on the current day, which are
+    limited to daily_budget. The cache is saved to path whenever it changes
+    """
+
+    def __init__(self, daily_budget=1000, path=None):
+        """Initializes the cache, loading it from path if it exists"""
+        self.daily_budget = daily_budget
+        self._path = path
+        self.data = None
+        self.etag = None
+        self.fetched = 0
+        self.day = None
+        self.calls = 0
+        self.load()
+
+    def load(self):
+        """Loads the forecast and the calls made today saved at path"""
+        saved = read_json(self._path)
+        if saved is None:
+            return
+        try:
+            self.data = saved['data']
+            self.etag = saved['etag']
+            self.fetched = saved['fetched']
+            self.day = saved['day']
+            self.calls = saved['calls']
+        except (KeyError, TypeError):
+            logger.warning('Ignoring unreadable forecast %s', self._path)
+            self.data = None
+            self.fetched = 0
+
+    def save(self):
+        """Writes the forecast and the calls made today to path"""
+        if not self._path:
+            return
+        write_json(self._path, {
+            'data': self.data,
+            'etag': self.etag,
+            'fetched': self.fetched,
+            'day': self.day,
+            'calls': self.calls
+        })
+
+    def get_age(self):
+        """Returns the number of seconds since the forecast was fetched"""
+        return time.time() - self.fetched
+
+    def get_calls_today(self):
+        """Returns the number of API calls made today"""
+        return self.calls if self.day == get_day() else 0
+
+    def use_call(self):
+        """
+        Counts an API call against today's budget, saving it before the
+        call is made so that failed calls count after a restart too. Returns
+        False without counting it once the budget has been used up
+        """
+        today = get_day()
+        if self.day != today:
+            self.day = today
+            self.calls = 0
+        if self.calls >= self.daily_budget:
+            return False
+        self.calls += 1
+        self.save()
+        return True
+
+    def store(self, data, etag=None):
+        """Replaces the cached forecast with a newly fetched one"""
+        self.data = data
+        self.etag = etag
+        self.fetched = time.time()
+        self.save()
+
+    def touch(self):
+        """Marks the cached forecast as fetched again, as it is unchanged"""
+        self.fetched = time.time()
+        self.save()
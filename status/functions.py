@@ -4,37 +4,138 @@ Contains functions and classes needed for processing the Network Status Page
 
 from __future__ import division
 
+import base64
+from collections import OrderedDict
 from datetime import datetime
+from functools import partial
+import heapq
 import json
+import logging
 import re
-import urllib
+import socket
+import time
+import zlib
 
-from flask import copy_current_request_context, url_for
-from flask_socketio import emit
-import forecastio
+from flask import copy_current_request_context, request, url_for
+from flask_socketio import emit, join_room, leave_room
+from forecastio.models import Forecast
 import gevent
-import paramiko
+from gevent.pool import Pool
 import requests
-from status import app, modules, socketio
-from status.views import (bandwidth, forecast, now_playing, recently_released,
-                          services, volumes)
+from requests.compat import quote, urlparse
+import status
+from status import (app, audience, breakers, bus, history, http_pool,
+                    image_cache, metrics, module_loader, modules, scheduler,
+                    snapshots, socketio)
+from status.channels import Channel
+from status.connections import discard_response, release_response
+from status.forecastcache import ForecastCache
+from status.library import RecentlyAddedIndex
+from status.plexxml import PlexDirectory, PlexVideo, iterparse_records
+from status.ssh import SSHCommandRunner
+from status.timeseries import RingBuffer
+from status.views import (bandwidth, forecast, get_volume_info, module_state,
+                          now_playing, recently_released, services, volumes)
 from xml.etree import ElementTree
 
+try:
+    import websocket
+except ImportError:
+    # Plex notifications are optional, polling is used without them
+    websocket = None
+
+logger = logging.getLogger(__name__)
+
+upstream_seconds = metrics.histogram(
+    'status_upstream_seconds', 'Time spent waiting on each upstream server')
+refresh_seconds = metrics.histogram(
+    'status_refresh_seconds', 'Time taken by the refresh job of each module')
+refresh_errors = metrics.counter(
+    'status_refresh_errors_total', 'Failed refreshes of each module')
+last_success_age = metrics.gauge(
+    'status_last_success_age_seconds',
+    'Seconds since the refresh job of each module last succeeded')
+scheduler_lag = metrics.gauge(
+    'status_scheduler_lag_seconds',
+    'How late the latest run of each refresh job started')
+scheduler_skipped = metrics.counter(
+    'status_scheduler_skipped_runs_total',
+    'Runs of each refresh job skipped because it fell behind')
+emits = metrics.counter(
+    'status_emits_total', 'SocketIO messages sent for each channel')
+emit_bytes = metrics.counter(
+    'status_emit_bytes_total',
+    'Bytes of SocketIO messages sent for each channel, counted once per '
+    'broadcast')
+emit_compressed_bytes = metrics.counter(
+    'status_emit_compressed_bytes_total',
+    'Bytes of the deflated SocketIO messages sent for each channel, counted '
+    'once per broadcast')
+connected_clients = metrics.gauge(
+    'status_connected_clients', 'SocketIO clients currently connected')
+image_lookups = metrics.counter(
+    'status_image_cache_lookups_total',
+    'Image proxy lookups by the cache tier that answered them')
+image_hit_rate = metrics.gauge(
+    'status_image_cache_hit_rate', 'Fraction of image lookups that were hits')
+
 
 class Plex:
     """Contains the functionality needed to communicate with a Plex server"""
     _STATUS_URL = '/status/sessions'
     _LIBRARY_URL = '/library/sections'
-    _RELEASED_URL = '/library/sections/{}/newest'
+    _RECENTLY_ADDED_URL = '/library/sections/{}/all'
+    _TRANSCODE_URL = '/photo/:/transcode'
+    _NOTIFICATIONS_URL = '/:/websockets/notifications'
+    _NOTIFICATIONS_RECONNECT_DELAY = 10
+    _ARTWORK_SIZES = {
+        'now_playing': {'width': 480, 'height': 720, 'quality': 80},
+        'recently_released': {'width': 400, 'height': 600, 'quality': 80}
+    }
 
     def __init__(
-            self, username, password, server_name, api_token_uri, **kwargs):
-        """Initializes the Plex server communication"""
+            self, username, password, server_name, api_token_uri,
+            concurrency=8, timeout=None, notifications=False,
+            notifications_url=None, notifications_poll_interval=30,
+            recently_released=10, recently_released_path=None,
+            section_cache_interval=3600, recently_released_resync=21600,
+            **kwargs):
+        """
+        Initializes the Plex server communication. With notifications
+        enabled, playback changes are pushed by Plex over a websocket and
+        /status/sessions is only polled every notifications_poll_interval
+        seconds, or whenever a session starts or stops. The newest
+        recently_released videos are indexed and saved to
+        recently_released_path, and the index is rebuilt from scratch every
+        recently_released_resync seconds to drop deleted videos
+        """
         self._username = username
         self._password = password
         self._server = server_name
         self._token_url = api_token_uri
+        self._concurrency = concurrency
+        self._timeout = timeout
+        self._token_refresh = None
+        self._sessions = {}
+        self._now_playing = None
+        self._last_poll = 0
+        self._poll_needed = True
+        self._notifications_url = notifications_url or '{}{}'.format(
+            re.sub(r'^http', 'ws', self._server), Plex._NOTIFICATIONS_URL)
+        self._notifications_poll_interval = notifications_poll_interval
+        self._notification_callback = None
+        self.notifications_connected = False
+        self._index = RecentlyAddedIndex(
+            recently_released, recently_released_path)
+        self._index_size = recently_released
+        self._sections = None
+        self._sections_fetched = 0
+        self._section_cache_interval = section_cache_interval
+        self._resync_interval = recently_released_resync
+        self._last_resync = time.time() if self._index.cursors else 0
         self.fetch_token()
+        if notifications and websocket is not None:
+            gevent.spawn(self.listen_for_notifications)
 
     def fetch_token(self):
         """Fetch's the Plex authentication token"""
@@ -44,7 +145,7 @@ class Plex:
         }
 
         tree = ElementTree.fromstring(
-            requests.post(
+            http_pool.post(
                 self._token_url,
                 auth=(self._username, self._password),
                 headers=headers
@@ -53,44 +154,98 @@ class Plex:
 
         self._payload = {'X-Plex-Token': tree.get('authenticationToken')}
 
-    def process_currently_playing_video(self, unprocessed_video):
+    def refresh_token(self, expired_payload):
         """
-        Returns a dictionary containing information for the provided video
+        Fetches a new authentication token unless the expired one has already
+        been replaced. Concurrent callers share a single refresh that runs in
+        its own greenlet
         """
-        video = {}
-        metadata_url = unprocessed_video.get('key')
+        if self._payload is not expired_payload:
+            return
+        if self._token_refresh is None or self._token_refresh.ready():
+            self._token_refresh = gevent.spawn(self.fetch_token)
+        self._token_refresh.get()
+
+    @upstream_seconds.time(upstream='plex')
+    def get(self, url, params=None, **kwargs):
+        """
+        Makes a request to Plex with the authentication token. If Plex rejects
+        the token, it is refreshed and the request is retried once. The
+        rejected response is drained so that its connection can be reused,
+        unless it was streamed, whose connection is discarded instead
+        """
+        payload = self._payload
+        response = http_pool.get(
+            url,
+            params=dict(payload, **(params or {})),
+            timeout=self._timeout,
+            **kwargs
+        )
+        if response.status_code == 401:
+            if kwargs.get('stream'):
+                discard_response(response)
+            else:
+                release_response(response)
+            self.refresh_token(payload)
+            response = http_pool.get(
+                url,
+                params=dict(self._payload, **(params or {})),
+                timeout=self._timeout,
+                **kwargs
+            )
+        return response
+
+    def fetch_xml(self, url, params=None, record_type=PlexVideo, limit=None):
+        """
+        Fetches the url from Plex and returns a list of records of
+        record_type for the matching elements in the XML. The response is
+        parsed as it streams in, and is no longer read once limit records
+        have been found. The connection is only reused once the rest of the
+        response has been read
+        """
+        response = self.get(url, params, stream=True)
         try:
-            video['device'] = unprocessed_video.find('Player').get('title')
-            video['state'] = unprocessed_video.find('Player').get('state')
-            video['user'] = unprocessed_video.find('User').get('title')
-        except AttributeError:
-            # unprocessed_video is not currently being watched
-            pass
+            response.raw.decode_content = True
+            records = iterparse_records(response.raw, record_type, limit)
+        except:
+            discard_response(response)
+            raise
+        release_response(response)
+        return records
 
-        video_tree = ElementTree.fromstring(
-            requests.get(
-                '{}{}'.format(self._server, metadata_url),
-                params=self._payload
-            ).content
-        )
+    def fetch_metadata(self, unprocessed_video):
+        """Fetches the metadata record for the provided video"""
+        return self.fetch_xml(self.get_metadata_url(unprocessed_video),
+                              limit=1)[0]
 
-        metadata = video_tree.find('Video')
+    def fetch_all_metadata(self, videos):
+        """
+        Fetches the metadata for all of the videos from Plex concurrently and
+        returns the records in the same order as the videos
+        """
+        if not videos:
+            return []
+        pool = Pool(min(self._concurrency, len(videos)))
+        return pool.map(self.fetch_metadata, videos)
 
-        try:
-            duration = float(metadata.get('duration'))
-            view_offset = float(metadata.get('viewOffset'))
-            video['progress'] = '{0:.2f}'.format(
-                (view_offset / duration) * 100)
-        except (AttributeError, TypeError):
-            # unproccessed_video is not currently being watched
-            pass
+    def get_metadata_url(self, unprocessed_video):
+        """Returns the url of the metadata for the provided video"""
+        return '{}{}'.format(self._server, unprocessed_video.get('key'))
+
+    def process_metadata(self, metadata, artwork_size):
+        """
+        Returns a dictionary containing the information about a video that
+        doesn't change during playback, with the artwork sized for the
+        template named by artwork_size
+        """
+        video = {}
+        video['duration'] = metadata.get('duration')
 
         video_type = metadata.get('type')
         video['type'] = video_type
+        thumb = metadata.get('thumb')
 
         if (video_type == 'movie'):
-            thumb = metadata.get('thumb')
-
             video['title'] = metadata.get('title')
             summary = metadata.get('summary')
             video['summary'] = (
@@ -107,93 +262,356 @@ class Plex:
 
         video['artwork'] = url_for(
             'fetch_image',
-            image=thumb
+            image=thumb,
+            **Plex._ARTWORK_SIZES[artwork_size]
         )
 
         return video
 
+    def process_session(self, video, unprocessed_video):
+        """
+        Adds the playback state of the provided video to the dictionary
+        returned by process_metadata
+        """
+        video['session_key'] = (
+            unprocessed_video.get('sessionKey') or
+            unprocessed_video.get('ratingKey'))
+        try:
+            video['device'] = unprocessed_video.find('Player').get('title')
+            video['state'] = unprocessed_video.find('Player').get('state')
+            video['user'] = unprocessed_video.find('User').get('title')
+        except AttributeError:
+            # unprocessed_video is not currently being watched
+            pass
+
+        try:
+            duration = float(video['duration'])
+            view_offset = float(unprocessed_video.get('viewOffset'))
+            video['progress'] = '{0:.2f}'.format(
+                (view_offset / duration) * 100)
+        except (TypeError, ZeroDivisionError):
+            # unproccessed_video is not currently being watched
+            pass
+
+        return video
+
+    def process_currently_playing_video(
+            self, unprocessed_video, metadata=None,
+            artwork_size='now_playing'):
+        """
+        Returns a dictionary containing information for the provided video.
+        The metadata is fetched from Plex unless it is provided, and the
+        artwork is sized for the template named by artwork_size
+        """
+        if metadata is None:
+            metadata = self.fetch_metadata(unprocessed_video)
+
+        video = self.process_metadata(metadata, artwork_size)
+        return self.process_session(video, unprocessed_video)
+
+    def get_session_key(self, unprocessed_video):
+        """Returns the key identifying the playback session of the video"""
+        return (
+            unprocessed_video.get('sessionKey'),
+            unprocessed_video.get('ratingKey'))
+
     def get_currently_playing_videos(self):
         """
         Returns a list of dictionaries containing information about all
-        currently playing videos
+        currently playing videos. The metadata of each session is only
+        fetched when it starts, after which only its playback state is
+        updated from the sessions. While notifications are connected, the
+        videos are kept up to date by them instead of polling the sessions
         """
-        tree = ElementTree.fromstring(
-            requests.get(
-                '{}{}'.format(self._server, Plex._STATUS_URL),
-                params=self._payload
-            ).content
-        )
+        if (self.notifications_connected and not self._poll_needed and
+                time.time() - self._last_poll <
+                self._notifications_poll_interval):
+            return [dict(video) for video in self._now_playing]
+
+        self._now_playing = self.poll_currently_playing_videos()
+        self._last_poll = time.time()
+        self._poll_needed = False
+        return [dict(video) for video in self._now_playing]
 
-        videos = tree.findall('Video')
+    def poll_currently_playing_videos(self):
+        """
+        Fetches the sessions from Plex and returns a list of dictionaries
+        containing information about all currently playing videos
+        """
+        videos = self.fetch_xml('{}{}'.format(self._server, Plex._STATUS_URL))
         if not videos:
+            self._sessions = {}
             return []
+
+        keys = [self.get_session_key(video) for video in videos]
+        started = [
+            video for video, key in zip(videos, keys)
+            if key not in self._sessions]
+        for video, metadata in zip(started, self.fetch_all_metadata(started)):
+            self._sessions[self.get_session_key(video)] = (
+                self.process_metadata(metadata, 'now_playing'))
+
+        self._sessions = dict((key, self._sessions[key]) for key in keys)
+        return [
+            self.process_session(dict(self._sessions[key]), video)
+            for video, key in zip(videos, keys)]
+
+    def set_notification_callback(self, callback):
+        """
+        Sets the function called with the type of each notification from Plex
+        that changed the currently playing or recently added videos
+        """
+        self._notification_callback = callback
+
+    def listen_for_notifications(self):
+        """
+        Keeps a websocket connected to the Plex notification feed and handles
+        every notification it receives, reconnecting whenever it drops
+        """
+        while True:
+            try:
+                connection = websocket.create_connection(
+                    '{}?X-Plex-Token={}'.format(
+                        self._notifications_url,
+                        self._payload['X-Plex-Token']),
+                    timeout=self._notifications_poll_interval)
+            except Exception:
+                gevent.sleep(Plex._NOTIFICATIONS_RECONNECT_DELAY)
+                continue
+
+            self.notifications_connected = True
+            # Anything missed while disconnected is picked up by a poll
+            self._poll_needed = True
+            try:
+                while True:
+                    try:
+                        message = connection.recv()
+                    except websocket.WebSocketTimeoutException:
+                        connection.ping()
+                        continue
+                    self.handle_notification(json.loads(message))
+            except Exception:
+                pass
+            finally:
+                self.notifications_connected = False
+                connection.close()
+            gevent.sleep(Plex._NOTIFICATIONS_RECONNECT_DELAY)
+
+    def handle_notification(self, message):
+        """
+        Applies a notification from Plex. Playing notifications for known
+        sessions update their progress and state in place, anything else
+        that changes the playing videos causes the sessions to be polled
+        """
+        container = message.get('NotificationContainer', message)
+        notification_type = container.get('type')
+        if notification_type == 'playing':
+            notifications = container.get(
+                'PlaySessionStateNotification', container.get('_children', []))
+            for notification in notifications:
+                self.update_session(notification)
+        elif notification_type != 'timeline':
+            return
+
+        if self._notification_callback:
+            self._notification_callback(notification_type)
+
+    def update_session(self, notification):
+        """
+        Updates the playback state of the session in the notification without
+        contacting Plex. Sessions that have stopped are dropped, and a
+        session that isn't known yet causes the sessions to be polled
+        """
+        session_key = str(notification.get('sessionKey'))
+        for index, video in enumerate(self._now_playing or []):
+            if video.get('session_key') != session_key:
+                continue
+            if notification.get('state') == 'stopped':
+                del self._now_playing[index]
+                return
+            video['state'] = notification.get('state')
+            try:
+                video['progress'] = '{0:.2f}'.format(
+                    float(notification.get('viewOffset')) /
+                    float(video['duration']) * 100)
+            except (TypeError, ValueError, ZeroDivisionError):
+                pass
+            return
+        if notification.get('state') != 'stopped':
+            self._poll_needed = True
+
+    def process_videos(self, videos, artwork_size):
+        """
+        Fetches the metadata for all of the videos concurrently and returns
+        a list of dictionaries containing information about them, in the
+        same order as the videos
+        """
         return [
-            self.process_currently_playing_video(video) for video in videos]
+            self.process_currently_playing_video(video, metadata, artwork_size)
+            for video, metadata in zip(
+                videos, self.fetch_all_metadata(videos))]
 
     def get_libraries_to_scan(self):
         """
-        Returns a list of urls of libraries to get recently playing videos
+        Returns a list of the keys of the libraries to get recently released
+        videos from. The list is only fetched from Plex every
+        section_cache_interval seconds
         """
-        section_tree = ElementTree.fromstring(
-            requests.get(
+        if (self._sections is not None and time.time() -
+                self._sections_fetched < self._section_cache_interval):
+            return self._sections
+
+        self._sections = [
+            directory.get('key') for directory in self.fetch_xml(
                 '{}{}'.format(self._server, Plex._LIBRARY_URL),
-                params=self._payload
-            ).content
-        )
+                record_type=PlexDirectory)]
+        self._sections_fetched = time.time()
+        return self._sections
 
-        directories = section_tree.findall('Directory')
-        return ['{}{}'.format(
-            self._server,
-            Plex._RELEASED_URL.format(
-                directory.get('key'))
-        ) for directory in directories]
+    def fetch_newest(self, section):
+        """
+        Returns the videos in the section that were added since it was last
+        fetched and are new enough to be in the index, newest first. When the
+        section has been fetched before, windows of growing size are requested
+        until an older video is found, so an unchanged section costs a single
+        one item request. The section is listed by addedAt, the key of the
+        cursor, as listings such as /newest are ordered by release date and
+        would hide old videos that were added recently
+        """
+        url = '{}{}'.format(
+            self._server, Plex._RECENTLY_ADDED_URL.format(section))
+        cursor = self._index.get_cursor(section)
+        minimum = self._index.get_minimum()
+        newer_than = max(cursor, minimum) if cursor is not None else minimum
+
+        start = 0
+        size = 1 if cursor is not None else self._index_size
+        videos = []
+        while True:
+            window = self.fetch_xml(url, {
+                'sort': 'addedAt:desc',
+                'X-Plex-Container-Start': start,
+                'X-Plex-Container-Size': size
+            }, limit=size)
+            for video in window:
+                if (newer_than is not None and
+                        int(video.get('addedAt', 0)) <= newer_than):
+                    return videos
+                videos.append(video)
+            start += len(window)
+            if len(window) < size or start >= self._index_size:
+                return videos
+            size = min(size * 2, self._index_size - start)
 
     def get_recently_released_videos(self):
         """
-        Returns a list of dictionaries containing information about all
-        recently released videos
+        Returns a list of dictionaries containing information about the
+        newest videos across all libraries. Only the videos added since the
+        previous call are fetched, along with their metadata
         """
         sections = self.get_libraries_to_scan()
-        processed_videos = []
-        for section in sections:
-            video_tree = ElementTree.fromstring(
-                requests.get(
-                    section,
-                    params=self._payload
-                ).content
-            )
-
-            videos = video_tree.findall('Video')
-            processed_videos.extend(
-                self.process_currently_playing_video(
-                    video) for video in videos[:5])
-
-        return processed_videos
-
-    def get_image_from_plex(self, image_url):
+        if (set(self._index.cursors) - set(sections) or
+                time.time() - self._last_resync > self._resync_interval):
+            self._index.clear()
+            self._last_resync = time.time()
+
+        if sections:
+            pool = Pool(min(self._concurrency, len(sections)))
+            newest = pool.map(self.fetch_newest, sections)
+        else:
+            newest = []
+
+        # Only the newest videos across all sections can make it into the
+        # index, so the metadata of the others is never fetched
+        added = heapq.nlargest(
+            self._index_size,
+            [video for videos in newest for video in videos],
+            key=lambda video: int(video.get('addedAt', 0)))
+        processed = dict(zip(
+            map(id, added), self.process_videos(added, 'recently_released')))
+        for section, videos in zip(sections, newest):
+            self._index.add(section, [
+                (int(video.get('addedAt', 0)), video.get('ratingKey'),
+                 processed[id(video)])
+                for video in videos if id(video) in processed])
+            if videos:
+                self._index.advance_cursor(section, max(
+                    int(video.get('addedAt', 0)) for video in videos))
+        if added:
+            self._index.save()
+
+        return self._index.get_videos()
+
+    def get_index_stats(self):
+        """Returns the statistics of the recently released index"""
+        return dict(
+            self._index.get_stats(),
+            sections=self._sections,
+            last_resync=self._last_resync)
+
+    def get_image_from_plex(
+            self, image_url, width=None, height=None, quality=None):
         """
-        Returns a raw response from a request to plex to fetch
-        the image to be displayed
+        Returns a streamed raw response from a request to plex to fetch
+        the image to be displayed. When a size is provided, Plex's photo
+        transcoder is used to scale the image down to fit within it
         """
-        return requests.get(
-            '{}{}'.format(self._server, image_url),
-            params=self._payload
+        if not (width or height):
+            return self.get(
+                '{}{}'.format(self._server, image_url), stream=True)
+
+        params = {'url': image_url, 'minSize': 1}
+        for name, value in [
+                ('width', width), ('height', height), ('quality', quality)]:
+            if value:
+                params[name] = value
+        return self.get(
+            '{}{}'.format(self._server, Plex._TRANSCODE_URL),
+            params=params,
+            stream=True
         )
 
 
 class ForecastIO:
     """
-    A Wrapper for the python-forecastio package allowing one time loading
-    of the API key and latitude/longitude coordinates
+    A wrapper for the Forecast.io API that keeps the latest forecast cached,
+    including on disk. A new forecast is only fetched once the cached one is
+    older than the refresh interval, which is shorter while precipitation is
+    expected, and never more often than the daily budget of API calls allows
     """
+    _API_URL = 'https://api.forecast.io'
+    _EXCLUDE = 'alerts,flags'
+    _DAY = 24 * 60 * 60
 
-    def __init__(self, api_key, latitude, longitude, **kwargs):
-        """Initializes an instance of the ForecastIO wrapper"""
-        self._api_key = api_key
+    def __init__(
+            self, api_key, latitude, longitude, base_url=None, cache_path=None,
+            daily_budget=1000, wet_interval=300, dry_interval=1800,
+            precipitation_threshold=0.3, timeout=10, **kwargs):
+        """
+        Initializes an instance of the ForecastIO wrapper. base_url replaces
+        the Forecast.io API server, such as with a local stand-in. The
+        forecast saved at cache_path is used until it is older than the
+        refresh interval: wet_interval seconds while the chance of
+        precipitation within the next few hours reaches
+        precipitation_threshold, and dry_interval seconds otherwise. At most
+        daily_budget API calls are made each day
+        """
         self._latitude = latitude
         self._longitude = longitude
-        self._forecast = forecastio.load_forecast(
-            self._api_key, self._latitude, self._longitude)
+        self._url = '{}/forecast/{}/{},{}'.format(
+            base_url or ForecastIO._API_URL, api_key, latitude, longitude)
+        self._wet_interval = wet_interval
+        self._dry_interval = dry_interval
+        self._precipitation_threshold = precipitation_threshold
+        self._timeout = timeout
+        self._cache = ForecastCache(daily_budget, cache_path)
+        self._forecast = None
+        self._weather = None
+        self.precipitation_expected = False
+        if self._cache.data is None:
+            self.update()
+        else:
+            self.parse()
 
     def get_direction(self, bearing):
         """Converts a bearing to written direction"""
@@ -220,8 +638,19 @@ class ForecastIO:
     def get_forecast(self):
         """
         Returns a dictionary containing the weather information we want to
-        display
+        display. It is only worked out again once a new forecast has been
+        fetched, apart from whether the sun has risen and set
         """
+        if self._weather is None:
+            self._weather = self.summarize()
+        weather = dict(self._weather)
+        now = datetime.now()
+        weather['rises'] = 'Rises' if weather['sunrise_time'] > now else 'Rose'
+        weather['sets'] = 'Sets' if weather['sunset_time'] > now else 'Set'
+        return weather
+
+    def summarize(self):
+        """Returns the fields of the forecast that are displayed"""
         weather = {}
         current = self._forecast.currently().d
         daily = self._forecast.daily()
@@ -236,16 +665,82 @@ class ForecastIO:
         weather['hour_summary'] = self._forecast.hourly().summary
         weather['sunrise_time'] = daily.data[0].sunriseTime
         weather['sunset_time'] = daily.data[0].sunsetTime
-        weather['rises'] = ('Rises' if weather['sunrise_time'] > datetime.now() else 'Rose')
-        weather['sets'] = 'Sets' if weather['sunset_time'] > datetime.now() else 'Set'
         weather['url'] = 'http://forecast.io/#/f/{},{}'.format(
             self._latitude, self._longitude)
 
         return weather
 
+    def parse(self):
+        """
+        Reads the cached forecast, working out whether precipitation is
+        expected within the next few hours
+        """
+        data = self._cache.data
+        self._forecast = Forecast(data, None, {})
+        self._weather = None
+        points = (
+            [data.get('currently', {})] +
+            data.get('minutely', {}).get('data', []) +
+            data.get('hourly', {}).get('data', [])[:3])
+        self.precipitation_expected = any(
+            point.get('precipProbability', 0) >=
+            self._precipitation_threshold for point in points)
+
+    def get_interval(self):
+        """
+        Returns how old the cached forecast may get before it is refreshed,
+        which is never less than the daily budget allows
+        """
+        interval = (
+            self._wet_interval if self.precipitation_expected
+            else self._dry_interval)
+        return max(interval, ForecastIO._DAY / self._cache.daily_budget)
+
     def update(self):
-        """Updates the forecast information"""
-        self._forecast.update()
+        """
+        Fetches a new forecast once the cached one is older than the refresh
+        interval, as long as there are API calls left in today's budget
+        """
+        if (self._cache.data is not None and
+                self._cache.get_age() < self.get_interval()):
+            return
+        if not self._cache.use_call():
+            if self._cache.data is None:
+                raise RuntimeError('The daily Forecast.io budget is used up')
+            return
+        self.fetch()
+
+    @upstream_seconds.time(upstream='forecast')
+    def fetch(self):
+        """
+        Fetches the forecast without the blocks that aren't displayed.
+        Forecasts that haven't changed since the cached one aren't parsed
+        """
+        headers = {}
+        if self._cache.data is not None and self._cache.etag:
+            headers['If-None-Match'] = self._cache.etag
+        response = http_pool.get(
+            self._url,
+            params={'units': 'auto', 'exclude': ForecastIO._EXCLUDE},
+            headers=headers,
+            timeout=self._timeout
+        )
+        if response.status_code == 304:
+            self._cache.touch()
+            return
+        response.raise_for_status()
+        self._cache.store(response.json(), response.headers.get('ETag'))
+        self.parse()
+
+    def get_stats(self):
+        """Returns the age of the forecast and today's API calls"""
+        return {
+            'age': self._cache.get_age(),
+            'interval': self.get_interval(),
+            'precipitation_expected': self.precipitation_expected,
+            'calls_today': self._cache.get_calls_today(),
+            'daily_budget': self._cache.daily_budget
+        }
 
 
 class PfSense:
@@ -253,27 +748,130 @@ class PfSense:
     Contains the functionality needed to communicate with a pfSense firewall
     """
 
-    def __init__(self, hostname, username, password, interfaces, **kwargs):
+    _LIVE_PATTERN = re.compile(
+        r'rx:\s*(?P<dl_speed>\d+\.?\d*) (?P<dl_units>\S+/s).*'
+        r'tx:\s*(?P<ul_speed>\d+\.?\d*) (?P<ul_units>\S+/s)')
+    _PING_PATTERN = re.compile(r'time=(?P<time>\d+\.?\d*) ms')
+    _SAMPLER_RESTART_DELAY = 5
+    _AVERAGED_SAMPLES = 5
+
+    def __init__(
+            self, hostname, username, password, interfaces, max_channels=8,
+            streaming=False, history=300, port=22, **kwargs):
         """Initializes the pfSense firewall communication"""
         self._hostname = hostname
         self._username = username
         self._password = password
         self._interfaces = interfaces
-        self._client = paramiko.SSHClient()
-        self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self._client.connect(
-            self._hostname, username=self._username, password=self._password)
+        self._streaming = streaming
+        self._history = dict(
+            (interface['name'], {
+                'dl': RingBuffer(history),
+                'ul': RingBuffer(history),
+                'ping': RingBuffer(history)
+            }) for interface in self._interfaces)
+        self._runner = SSHCommandRunner(
+            self._hostname, self._username, self._password,
+            max_channels=max_channels, port=port)
+        self._runner.connect()
+        self._samplers = []
+        if self._streaming:
+            self.start_samplers()
         self.get_current_bandwidth_stats()
 
+    def convert_to_mbits(self, speed, units):
+        """Converts a speed reported by vnstat to Mbit/s"""
+        speed = float(speed)
+        if units == 'kbit/s':
+            speed /= 1024
+        elif units == 'bit/s':
+            speed /= 1024 * 1024
+        elif units == 'Gbit/s':
+            speed *= 1024
+        return speed
+
+    def start_samplers(self):
+        """
+        Spawns the greenlets that continuously sample the bandwidth usage and
+        ping time of every interface, unless they are already running
+        """
+        if self._samplers:
+            return
+        for interface in self._interfaces:
+            self._samplers.append(gevent.spawn(
+                self.sample_bandwidth_on_interface, interface))
+            self._samplers.append(gevent.spawn(
+                self.sample_ping_on_interface, interface))
+
+    def stop_samplers(self):
+        """
+        Kills the sampling greenlets, which closes the channels of the
+        commands they were running on pfSense
+        """
+        gevent.killall(self._samplers)
+        self._samplers = []
+
+    def set_idle(self, idle):
+        """
+        Stops sampling while nobody is watching the bandwidth, so that pfSense
+        isn't kept busy, and starts again once somebody is
+        """
+        if not self._streaming:
+            return
+        if idle:
+            self.stop_samplers()
+        else:
+            self.start_samplers()
+
+    def sample_bandwidth_on_interface(self, interface):
+        """
+        Keeps vnstat running in live mode on the interface and records every
+        sample it reports, restarting it whenever it stops
+        """
+        history = self._history[interface['name']]
+        while True:
+            try:
+                for line in self._runner.stream(
+                        'vnstat -l -i {}'.format(interface['name'])):
+                    match = re.search(PfSense._LIVE_PATTERN, line)
+                    if match:
+                        history['dl'].append(self.convert_to_mbits(
+                            match.group('dl_speed'), match.group('dl_units')))
+                        history['ul'].append(self.convert_to_mbits(
+                            match.group('ul_speed'), match.group('ul_units')))
+            except Exception:
+                logger.exception(
+                    'vnstat stopped on %s, restarting it', interface['name'])
+            gevent.sleep(PfSense._SAMPLER_RESTART_DELAY)
+
+    def sample_ping_on_interface(self, interface):
+        """
+        Keeps ping running on the interface and records the time of every
+        reply, restarting it whenever it stops
+        """
+        history = self._history[interface['name']]
+        while True:
+            try:
+                for line in self._runner.stream(
+                        'ping -S {} {}'.format(
+                            interface['ip'], interface['ping_ip'])):
+                    match = re.search(PfSense._PING_PATTERN, line)
+                    if match:
+                        history['ping'].append(float(match.group('time')))
+            except Exception:
+                logger.exception(
+                    'ping stopped on %s, restarting it', interface['name'])
+            gevent.sleep(PfSense._SAMPLER_RESTART_DELAY)
+
+    @upstream_seconds.time(upstream='pfsense')
     def get_current_bandwidth_usage_on_interface(self, interface_name):
         """
         Connects to pfSense and fetches the current amount of traffic passing
         through the specified interface_name
         """
         try:
-            stdin, stdout, stderr = self._client.exec_command(
+            output = self._runner.run(
                 'vnstat -i {} -tr'.format(interface_name))
-            output = stdout.readlines()
             dl_speed_line = str(output[-3])
             ul_speed_line = str(output[-2])
 
@@ -298,25 +896,64 @@ class PfSense:
 
     def get_current_bandwidth_stats(self):
         """
-        Loops through all interfaces and gets the amount of traffic passing
-        through each of them
+        Probes all interfaces in parallel and gets the amount of traffic
+        passing through each of them. When streaming, the latest samples are
+        used instead of probing the interfaces
         """
-        for interface in self._interfaces:
-            interface['dl_speed'], interface['ul_speed'] = self.get_current_bandwidth_usage_on_interface(interface['name'])
-            interface['dl_usage'] = 100 * interface['dl_speed'] / interface['max_dl_speed']
-            interface['ul_usage'] = 100 * interface['ul_speed'] / interface['max_ul_speed']
-            interface['ping'] = self.get_current_ping_time_on_interface(interface)
+        if self._streaming:
+            for interface in self._interfaces:
+                self.update_interface_from_history(interface)
+            return
+
+        gevent.joinall([
+            gevent.spawn(self.update_interface, interface)
+            for interface in self._interfaces])
 
+    def update_interface(self, interface):
+        """
+        Measures the bandwidth usage and ping time of the interface at the
+        same time and stores them on the interface
+        """
+        usage = gevent.spawn(
+            self.get_current_bandwidth_usage_on_interface, interface['name'])
+        ping = gevent.spawn(self.get_current_ping_time_on_interface, interface)
+        gevent.joinall([usage, ping])
+
+        interface['dl_speed'], interface['ul_speed'] = usage.value
+        interface['dl_usage'] = 100 * interface['dl_speed'] / interface['max_dl_speed']
+        interface['ul_usage'] = 100 * interface['ul_speed'] / interface['max_ul_speed']
+        interface['ping'] = ping.value
+
+    def update_interface_from_history(self, interface):
+        """
+        Stores the average of the latest samples on the interface along with
+        a sparkline and summary of each history
+        """
+        history = self._history[interface['name']]
+        samples = PfSense._AVERAGED_SAMPLES
+        interface['dl_speed'] = round(history['dl'].mean(samples) or 0, 2)
+        interface['ul_speed'] = round(history['ul'].mean(samples) or 0, 2)
+        interface['dl_usage'] = 100 * interface['dl_speed'] / interface['max_dl_speed']
+        interface['ul_usage'] = 100 * interface['ul_speed'] / interface['max_ul_speed']
+        interface['ping'] = int(round(history['ping'].mean(samples) or 0))
+
+        for name, recorded in history.items():
+            summary = recorded.get_summary()
+            interface['{}_sparkline'.format(name)] = recorded.get_sparkline()
+            interface['{}_summary'.format(name)] = (
+                'min {min:.2f} / avg {avg:.2f} / p95 {p95:.2f}'.format(
+                    **summary) if summary else '')
+
+    @upstream_seconds.time(upstream='pfsense')
     def get_current_ping_time_on_interface(self, interface):
         """
         Connects to pfSense and gets the average ping time to the specified
         ip address
         """
         try:
-            stdin, stdout, stderr = self._client.exec_command(
+            output = self._runner.run(
                 'ping -S {} -t 5 {}'.format(
                     interface['ip'], interface['ping_ip']))
-            output = stdout.readlines()
             avg_ping_line = str(output[-1])
 
             pattern = re.compile(r'\d+.\d*\/(?P<average>\d+.\d*)')
@@ -336,20 +973,65 @@ class PfSense:
 
 
 class Services:
+    """
+    Contains the functionality needed to check whether services are online
+    """
 
-    def __init__(self, service_list):
+    def __init__(self, service_list, concurrency=10, timeout=5, **kwargs):
         """
         Initializes the services class and stores information about
         the services to check
         """
         self._service_list = service_list
+        self._concurrency = concurrency
+        self._timeout = timeout
         self.update_status()
 
     def update_status(self):
-        """Updates the status of all services"""
-        for service in self._service_list:
-            url = "{}:{}".format(service['hostname'], service['port'])
-            service['status'] = True if urllib.urlopen(url).getcode() == 200 else False
+        """
+        Updates the status of all services, checking up to concurrency
+        services at the same time
+        """
+        if not self._service_list:
+            return
+        pool = Pool(min(self._concurrency, len(self._service_list)))
+        pool.map(self.check_service, self._service_list)
+
+    @upstream_seconds.time(upstream='services')
+    def check_service(self, service):
+        """
+        Checks whether the service is online and records how long the check
+        took in milliseconds. Services with a 'tcp' probe only need to accept
+        a connection, all others need to respond to a request with a 200
+        """
+        start = time.time()
+        try:
+            with gevent.Timeout(self._timeout):
+                if service.get('probe') == 'tcp':
+                    service['status'] = self.check_tcp_connection(service)
+                else:
+                    service['status'] = self.check_http_response(service)
+        except (gevent.Timeout, socket.error, requests.RequestException):
+            service['status'] = False
+
+        service['latency'] = (
+            int(round((time.time() - start) * 1000))
+            if service['status'] else None)
+
+    def check_tcp_connection(self, service):
+        """Returns whether a TCP connection to the service can be opened"""
+        hostname = service['hostname']
+        if '//' in hostname:
+            hostname = urlparse(hostname).hostname
+        connection = socket.create_connection(
+            (hostname, int(service['port'])), self._timeout)
+        connection.close()
+        return True
+
+    def check_http_response(self, service):
+        """Returns whether the service responds to a request with a 200"""
+        url = "{}:{}".format(service['hostname'], service['port'])
+        return http_pool.get(url, timeout=self._timeout).status_code == 200
 
     def get_status(self):
         """Returns the service list"""
@@ -357,40 +1039,173 @@ class Services:
 
 
 class Freenas:
-    """Contains the functionality needed to communicate with the Freenas API"""
+    """
+    Contains the functionality needed to communicate with the Freenas API of
+    one or more hosts
+    """
     _VOLUME_URL = '/api/v1.0/storage/volume/'
+    _DATASETS_URL = '/api/v1.0/storage/volume/{}/datasets/'
+    _MAX_DATASETS_PAGE = 200
 
-    def __init__(self, hostname, username, password, **kwargs):
-        """Initializes an instance of the Freenas API"""
-        self._hostname = hostname
-        self._username = username
-        self._password = password
-        self.update_status()
+    def __init__(
+            self, hostname=None, username=None, password=None, hosts=None,
+            concurrency=4, timeout=10, verify=True, **kwargs):
+        """
+        Initializes an instance of the Freenas API for each of the hosts,
+        given as dictionaries with a hostname, username and password and
+        optionally a name and whether to verify its certificate. A single
+        host can be given by its hostname, username and password instead.
+        The hosts are polled concurrently and each request gives up after
+        timeout seconds. Hosts that can't be reached at startup are left out
+        until they can be, as long as at least one host can
+        """
+        if hosts is None:
+            hosts = [{
+                'hostname': hostname,
+                'username': username,
+                'password': password
+            }]
+        self._hosts = OrderedDict()
+        for host in hosts:
+            name = (host.get('name') or urlparse(host['hostname']).netloc or
+                    host['hostname'])
+            self._hosts[name] = dict({'verify': verify}, **host)
+        self._concurrency = concurrency
+        self._timeout = timeout
+        self._host_volumes = dict((name, []) for name in self._hosts)
+        self._host_totals = dict((name, (0, 0)) for name in self._hosts)
+        self._volumes = []
+        self._total_space = 0
+        self._total_avail = 0
+        self._percent_used = '0%'
+        errors = self.poll_hosts()
+        if len(errors) == len(self._hosts):
+            raise errors[0]
 
     def update_status(self):
-        """Updates the status for all volumes"""
-        response = requests.get(
-            '{}{}'.format(self._hostname, Freenas._VOLUME_URL),
-            auth=(self._username, self._password), verify=False)
-        volume_details = json.loads(response.content)
+        """
+        Updates the status for all volumes, polling every host concurrently.
+        Hosts that fail keep their last known volumes, and the first failure
+        is raised once the other hosts have been updated
+        """
+        errors = self.poll_hosts()
+        if errors:
+            raise errors[0]
+
+    def poll_hosts(self):
+        """
+        Polls every host concurrently, updating the volumes of those that
+        responded, and returns the errors of those that failed
+        """
+        pool = Pool(min(self._concurrency, len(self._hosts)))
+        results = pool.map(self.poll_host, self._hosts)
+
+        errors = []
+        for name, result in zip(self._hosts, results):
+            if isinstance(result, (Exception, gevent.Timeout)):
+                errors.append(result)
+            else:
+                self.set_host_volumes(name, result)
+        self._volumes = [
+            volume for name in self._hosts
+            for volume in self._host_volumes[name]]
+        return errors
+
+    def poll_host(self, name):
+        """
+        Returns the volumes of the host, or the exception raised while
+        fetching them
+        """
+        try:
+            return self.fetch_volumes(name)
+        except (Exception, gevent.Timeout) as error:
+            return error
+
+    @upstream_seconds.time(upstream='freenas')
+    def fetch_volumes(self, name):
+        """Fetches the details of every volume of the host"""
+        host = self._hosts[name]
+        response = http_pool.get(
+            '{}{}'.format(host['hostname'], Freenas._VOLUME_URL),
+            auth=(host['username'], host['password']),
+            verify=host['verify'], timeout=self._timeout)
+        response.raise_for_status()
 
         volumes = []
-        total_space = 0
-        total_avail = 0
-        for volume in volume_details:
+        for volume in response.json():
             vol_info = {}
-            vol_info['name'] = volume['vol_name']
+            vol_info['host'] = name
+            vol_info['volume'] = volume['vol_name']
+            vol_info['name'] = (
+                volume['vol_name'] if len(self._hosts) == 1
+                else '{}/{}'.format(name, volume['vol_name']))
             vol_info['used_percent'] = volume['used_pct']
             vol_info['space_avail'] = volume['avail']
             vol_info['total_space'] = volume['avail'] + volume['used']
-            total_space += volume['avail'] + volume['used']
-            total_avail += volume['avail']
             volumes.append(vol_info)
-        self._volumes = volumes
-        self._total_space = total_space
-        self._total_avail = total_avail
+        return volumes
+
+    def set_host_volumes(self, name, volumes):
+        """
+        Replaces the volumes of the host, adjusting the totals across all
+        hosts by the difference from its previous volumes
+        """
+        total_space = sum(volume['total_space'] for volume in volumes)
+        total_avail = sum(volume['space_avail'] for volume in volumes)
+        previous_space, previous_avail = self._host_totals[name]
+        self._host_volumes[name] = volumes
+        self._host_totals[name] = (total_space, total_avail)
+        self._total_space += total_space - previous_space
+        self._total_avail += total_avail - previous_avail
         self._percent_used = "{}%".format(
-            int((total_space-total_avail)/total_space*100))
+            int((self._total_space - self._total_avail) /
+                self._total_space * 100) if self._total_space else 0)
+
+    def has_volume(self, name, volume):
+        """Returns whether the host has a volume with that name"""
+        return any(
+            vol_info['volume'] == volume
+            for vol_info in self._host_volumes.get(name, []))
+
+    @upstream_seconds.time(upstream='freenas')
+    def get_datasets(self, name, volume, offset=0, limit=50):
+        """
+        Returns a page of up to limit datasets of the volume on the host,
+        starting at offset. FreeNAS pages the datasets itself, so a large
+        pool is never fetched in one response
+        """
+        host = self._hosts[name]
+        offset = max(offset, 0)
+        limit = max(1, min(limit, Freenas._MAX_DATASETS_PAGE))
+        response = http_pool.get(
+            '{}{}'.format(
+                host['hostname'],
+                Freenas._DATASETS_URL.format(quote(volume, safe=''))),
+            params={'offset': offset, 'limit': limit},
+            auth=(host['username'], host['password']),
+            verify=host['verify'], timeout=self._timeout)
+        response.raise_for_status()
+
+        datasets = []
+        for dataset in response.json():
+            total_space = dataset['avail'] + dataset['used']
+            datasets.append({
+                'name': dataset['name'],
+                'mountpoint': dataset.get('mountpoint'),
+                'used_percent': '{}%'.format(
+                    int(dataset['used'] / total_space * 100)
+                    if total_space else 0),
+                'space_avail': dataset['avail'],
+                'total_space': total_space
+            })
+        return {
+            'host': name,
+            'volume': volume,
+            'offset': offset,
+            'limit': limit,
+            'next_offset': offset + limit if len(datasets) == limit else None,
+            'datasets': datasets
+        }
 
     def get_volumes(self):
         """Returns the list containing the details about all volumes"""
@@ -409,95 +1224,595 @@ class Freenas:
         return self._percent_used
 
 
-@app.before_first_request
-def spawn_greenlet():
-    """Spawns greenlets to update information from modules via SocketIO"""
+_recently_released = {}
 
-    @copy_current_request_context
-    def greenlet_get_now_playing():
-        """
-        A greenlet that communicates with Plex every second to update
-        the now playing information via SocketIO
-        """
 
-        last_now_playing = True
-        while True:
-            cur = now_playing()
-            if not cur:
-                if last_now_playing:
-                    socketio.emit('plex', {'data': recently_released()})
-                    last_now_playing = False
-            else:
-                last_now_playing = True
-                socketio.emit('plex', {'data': cur})
-            gevent.sleep(1)
+def get_plex_videos():
+    """
+    Returns the videos to display in the plex channel. The recently released
+    videos are only fetched when playback stops, and reused until it resumes
+    """
+    videos = modules['plex'].get_currently_playing_videos()
+    if videos:
+        _recently_released.clear()
+        return {'now_playing': True, 'videos': videos}
+    if 'videos' not in _recently_released:
+        _recently_released['videos'] = (
+            modules['plex'].get_recently_released_videos())
+    return {'now_playing': False, 'videos': _recently_released['videos']}
 
-    gevent.spawn(greenlet_get_now_playing)
 
-    @copy_current_request_context
-    def greenlet_get_forecast():
-        """
-        A greenlet that communicates with Forecast.io every 2 minutes to
-        update the weather information via SocketIO
-        """
+def render_plex_videos(data):
+    """Renders the plex channel from the data from get_plex_videos"""
+    if data['now_playing']:
+        return now_playing(data['videos'])
+    return recently_released(data['videos'])
 
-        while True:
-            socketio.emit('forecast', {'data': forecast()})
-            gevent.sleep(600)
-            modules['forecast'].update()
 
-    gevent.spawn(greenlet_get_forecast)
+CHANNELS = ['plex', 'forecast', 'bandwidth', 'services', 'volumes']
 
-    @copy_current_request_context
-    def greenlet_get_bandwidth():
-        """
-        A greenlet that communicates with pfSense every 15 seconds to update
-        the bandwidth information via SocketIO
-        """
+PLAIN_ROOM = 'plain'
+DEFLATE_ROOM = 'deflate'
+_compression = {'threshold': None}
+_deflate_clients = set()
+# The version of the latest message the poller sent for each channel, and
+# the channels whose snapshot has been asked for, on a front end
+_poller_versions = {}
+_requested_snapshots = set()
 
-        while True:
-            socketio.emit('bandwidth', {'data': bandwidth()})
-            gevent.sleep(15)
-            modules['pfsense'].get_current_bandwidth_stats()
 
-    gevent.spawn(greenlet_get_bandwidth)
+def configure_compression():
+    """
+    Enables deflated messages for the clients that can inflate them, for
+    messages of at least compression_threshold bytes
+    """
+    channel_config = status.config.get('channels', {})
+    _compression['threshold'] = (
+        channel_config.get('compression_threshold', 512)
+        if channel_config.get('compression', True) else None)
+
 
-    @copy_current_request_context
-    def greenlet_get_services():
-        """
-        A greenlet that checks service status every 2 minutes to update
-        status via SocketIO
-        """
+def count_emit(channel, event, size):
+    """Counts a message sent for the channel and its size in bytes"""
+    emits.inc(channel=channel, event=event)
+    emit_bytes.inc(size, channel=channel)
 
-        while True:
-            socketio.emit('services', {'data': services()})
-            gevent.sleep(30)
-            modules['services'].update_status()
 
-    gevent.spawn(greenlet_get_services)
+def compress(encoded):
+    """
+    Returns the message encoded as JSON deflated and then base64 encoded, or
+    None when compression is disabled or the message is too small for it
+    """
+    threshold = _compression['threshold']
+    if threshold is None or len(encoded) < threshold:
+        return None
+    return base64.b64encode(
+        zlib.compress(encoded.encode('utf-8'))).decode('ascii')
+
 
-    @copy_current_request_context
-    def greenlet_get_volumes():
+def send_to_clients(channel, event, payload, frame=None):
+    """
+    Sends the message to all clients. When it has a deflated frame, clients
+    that can inflate messages are sent the frame instead, so a message is
+    only ever encoded and compressed once however many clients there are
+    """
+    if frame is None:
+        socketio.emit(event, payload)
+        return
+    emit_compressed_bytes.inc(len(frame), channel=channel)
+    socketio.emit(event, payload, room=PLAIN_ROOM)
+    socketio.emit(event, {'deflate': frame}, room=DEFLATE_ROOM)
+
+
+def broadcaster(channel):
+    """
+    Returns the function that the channel uses to send its messages to all
+    clients, which also counts them
+    """
+    def broadcast(event, payload):
         """
-        A greenlet that checks volume status every 2 minutes to update via
-        SocketIO
+        Sends the message to all clients. The poller publishes it to the
+        front ends instead, along with its deflated frame so that the front
+        ends never need to compress anything. Full panels carry the channel's
+        snapshot, while patches leave it unrendered until a front end asks
+        for it
         """
+        encoded = json.dumps(payload)
+        count_emit(channel, event, len(encoded))
+        frame = compress(encoded)
+        if bus.role == bus.POLLER:
+            bus.publish({
+                'type': 'emit',
+                'channel': channel,
+                'event': event,
+                'payload': payload,
+                'frame': frame,
+                'snapshot': get_snapshot(channel) if event == channel else None
+            })
+        else:
+            send_to_clients(channel, event, payload, frame)
+    return broadcast
+
+
+def get_snapshot(channel):
+    """
+    Returns the latest snapshot of the channel without its renderer or the
+    message built from it
+    """
+    snapshot = snapshots.get(channel)
+    if snapshot is None:
+        return None
+    return dict(
+        (name, value) for name, value in snapshot.items()
+        if name not in ('render', 'message'))
 
-        while True:
-            socket.io.emit('volumes', {'data': volumes()})
-            gevent.sleep(120)
-            modules['freenas'].update_status()
+
+def get_snapshot_message(snapshot):
+    """
+    Returns the message that sends the snapshot to a client, its size and
+    its deflated frame. They are built once per version of the snapshot
+    and kept in it until the snapshot goes stale or fresh again
+    """
+    message = snapshot.get('message')
+    if (message is None or
+            message[0]['stale_since'] != snapshot.get('stale_since')):
+        payload = {
+            'data': snapshot['data'],
+            'version': snapshot['version'],
+            'stale_since': snapshot.get('stale_since')
+        }
+        encoded = json.dumps(payload)
+        message = snapshot['message'] = (
+            payload, len(encoded), compress(encoded))
+    return message
+
+
+def get_bandwidth():
+    """
+    Returns the interfaces to display in the bandwidth channel, along with
+    the peak speeds of each one over the last day as last computed by the
+    history store, so the refresh never waits on the database
+    """
+    interfaces = modules['pfsense'].get_interfaces()
+    aggregates = history.get_aggregates([
+        'bandwidth.{}.{}'.format(interface['name'], field)
+        for interface in interfaces for field in ('dl_speed', 'ul_speed')])
+    for interface in interfaces:
+        for field in ('dl', 'ul'):
+            peak = aggregates.get('bandwidth.{}.{}_speed'.format(
+                interface['name'], field))
+            interface['{}_peak'.format(field)] = (
+                round(peak['max'], 2) if peak else None)
+    return interfaces
+
+
+def get_service_status():
+    """
+    Returns the services to display in the services channel, along with the
+    percentage of checks over the last day that found each one online, as
+    last computed by the history store
+    """
+    service_list = modules['services'].get_status()
+    aggregates = history.get_aggregates([
+        'services.{}.up'.format(service['name']) for service in service_list])
+    for service in service_list:
+        uptime = aggregates.get('services.{}.up'.format(service['name']))
+        service['uptime'] = (
+            round(uptime['avg'] * 100, 1) if uptime else None)
+    return service_list
+
+
+def record_bandwidth_history(interfaces):
+    """Records the speeds and ping time of every interface"""
+    for interface in interfaces:
+        for field in ('dl_speed', 'ul_speed', 'ping'):
+            history.record(
+                'bandwidth.{}.{}'.format(interface['name'], field),
+                interface.get(field))
+
+
+def record_service_history(service_list):
+    """Records whether every service is online and its latency"""
+    for service in service_list:
+        history.record(
+            'services.{}.up'.format(service['name']),
+            1 if service.get('status') else 0)
+        history.record(
+            'services.{}.latency'.format(service['name']),
+            service.get('latency'))
+
+
+def record_volume_history(volume_info):
+    """Records the available space and usage of every volume"""
+    for volume in volume_info['volume_list']:
+        history.record(
+            'volumes.{}.space_avail'.format(volume['name']),
+            volume['space_avail'])
+        history.record(
+            'volumes.{}.used_percent'.format(volume['name']),
+            str(volume['used_percent']).rstrip('%'))
+
+
+channels = {
+    'plex': Channel(
+        'plex', get_plex_videos, render_plex_videos,
+        snapshots, broadcaster('plex'),
+        records=lambda data: data['videos'] if data['now_playing'] else None,
+        key='session_key', fields=('progress', 'state')),
+    'forecast': Channel(
+        'forecast', lambda: modules['forecast'].get_forecast(), forecast,
+        snapshots, broadcaster('forecast')),
+    'bandwidth': Channel(
+        'bandwidth', get_bandwidth, bandwidth,
+        snapshots, broadcaster('bandwidth'), key='name',
+        fields=('dl_speed', 'ul_speed', 'dl_usage', 'ul_usage', 'ping',
+                'dl_sparkline', 'ul_sparkline', 'ping_sparkline',
+                'dl_summary', 'ul_summary', 'ping_summary',
+                'dl_peak', 'ul_peak')),
+    'services': Channel(
+        'services', get_service_status, services,
+        snapshots, broadcaster('services'), key='name',
+        fields=('latency', 'uptime')),
+    'volumes': Channel(
+        'volumes', get_volume_info, volumes, snapshots, broadcaster('volumes'))
+}
+
+# The function recording the history of each channel's data
+HISTORY_RECORDERS = {
+    'bandwidth': record_bandwidth_history,
+    'services': record_service_history,
+    'volumes': record_volume_history
+}
+
+
+# The refresh job of each module as (module, update, channel, interval).
+# update fetches new data from the upstream server into the module, and
+# is None when refreshing the channel already fetches it
+REFRESH_JOBS = [
+    ('plex', None, 'plex', 1),
+    ('forecast', lambda: modules['forecast'].update(), 'forecast', 60),
+    ('pfsense', lambda: modules['pfsense'].get_current_bandwidth_stats(),
+     'bandwidth', 15),
+    ('services', lambda: modules['services'].update_status(), 'services', 30),
+    ('freenas', lambda: modules['freenas'].update_status(), 'volumes', 120)
+]
+
+
+def refresh_module(module, update, channel):
+    """
+    Updates a module from its upstream server and publishes its channel.
+    Modules that were just loaded already have fresh data and aren't updated,
+    and a placeholder is published for modules that haven't loaded yet.
+
+    The upstream calls go through the module's circuit breaker. If they fail
+    the last published data is kept and marked as stale until they succeed
+    """
+    if module not in modules:
+        channels[channel].publish_placeholder(
+            module_state(module_loader.get_state(module)))
+        return
+
+    def fetch():
+        """Updates the module and returns the source data of the channel"""
+        if update and not module_loader.pop_fresh(module):
+            update()
+        return channels[channel].fetch()
+
+    with refresh_seconds.time(module=module):
+        try:
+            data = breakers.get(module).call(fetch)
+        except (Exception, gevent.Timeout):
+            refresh_errors.inc(module=module)
+            channels[channel].mark_stale()
+            raise
+        if channel in HISTORY_RECORDERS:
+            HISTORY_RECORDERS[channel](data)
+        channels[channel].refresh(data)
+
+
+def trigger_refresh(module):
+    """Refreshes the channel of a module as soon as possible"""
+    if scheduler.get_job(module):
+        scheduler.trigger(module)
+
+
+def handle_plex_notification(notification_type):
+    """
+    Refreshes the plex channel when Plex notifies us of a change, dropping
+    the recently released videos when the library has changed
+    """
+    if notification_type == 'timeline':
+        _recently_released.clear()
+    trigger_refresh('plex')
+
+
+def handle_loaded_module(module):
+    """Refreshes the channel of a module as soon as it has been loaded"""
+    if module == 'plex':
+        modules['plex'].set_notification_callback(handle_plex_notification)
+    job = scheduler.get_job(module)
+    if job and job.idle:
+        set_module_idle(module, True)
+    trigger_refresh(module)
+
+
+module_loader.add_ready_callback(handle_loaded_module)
+
+
+@app.before_first_request
+def spawn_greenlet():
+    """
+    Registers the refresh job of each module with the scheduler, using the
+    interval and jitter from the configuration, and starts the scheduler.
+    Jobs for channels that nobody is watching start out idle. Front ends
+    leave the jobs to the poller
+    """
+    history.start()
+    configure_compression()
+    if bus.role == bus.FRONTEND:
+        return
+
+    delta_updates = status.config.get('channels', {}).get(
+        'delta_updates', True)
+    for channel in channels.values():
+        channel.delta_updates = delta_updates
+
+    job_config = status.config.get('scheduler', {})
+    for module, update, channel, interval in REFRESH_JOBS:
+        options = dict({'interval': interval}, **job_config.get(module, {}))
+        scheduler.add_job(
+            module,
+            copy_current_request_context(
+                partial(refresh_module, module, update, channel)),
+            **options)
+        scheduler.set_idle(module, not audience.get_watchers(channel))
+        set_module_idle(module, not audience.get_watchers(channel))
+
+    scheduler.start()
+
+
+def collect_metrics():
+    """Copies the values kept by the scheduler, audience and image cache"""
+    now = time.time()
+    for module, job in scheduler.get_stats().items():
+        if job['last_success'] is not None:
+            last_success_age.set(now - job['last_success'], module=module)
+        if job['last_lag'] is not None:
+            scheduler_lag.set(job['last_lag'], module=module)
+        scheduler_skipped.set(job['skipped'], module=module)
+    connected_clients.set(audience.get_client_count())
+    image_stats = image_cache.get_stats()
+    for tier, count in image_stats['hits'].items():
+        image_lookups.set(count, tier=tier)
+    if image_stats['hit_rate'] is not None:
+        image_hit_rate.set(image_stats['hit_rate'])
+
+
+metrics.add_collector(collect_metrics)
+
+
+def start_poller():
+    """
+    Starts the refresh jobs outside of any request and serves the front ends
+    on the message bus. Channels are only refreshed while a front end has a
+    client watching them
+    """
+    with app.test_request_context('/'):
+        spawn_greenlet()
+    bus.serve(send_snapshots, handle_frontend_message, handle_frontend_close)
+
+
+def send_snapshots(subscriber):
+    """Sends the latest snapshot of every channel to a new front end"""
+    for channel in snapshots.get_channels():
+        subscriber.send_message({
+            'type': 'snapshot',
+            'channel': channel,
+            'snapshot': get_snapshot(channel)
+        })
+
+
+def handle_frontend_message(frontend, message):
+    """
+    Tracks the channels watched by the clients of a front end, which the
+    poller treats as a single client watching all of them, and sends it the
+    snapshots it asks for
+    """
+    if message.get('type') == 'snapshot_request':
+        if message['channel'] in CHANNELS:
+            bus.send_to(frontend, {
+                'type': 'snapshot',
+                'channel': message['channel'],
+                'snapshot': get_snapshot(message['channel'])
+            })
+        return
+    if message.get('type') != 'watchers':
+        return
+    watched = set(channel for channel in message['channels']
+                  if channel in CHANNELS)
+    stopped = audience.get_watched(frontend) - watched
+    set_channels_idle(audience.unwatch(frontend, list(stopped)), True)
+    set_channels_idle(audience.watch(frontend, list(watched)), False)
+
+
+def handle_frontend_close(frontend):
+    """Lets the channels only watched through the front end go idle"""
+    set_channels_idle(audience.disconnect(frontend), True)
+
+
+def start_frontend():
+    """Subscribes to the snapshots published by the poller"""
+    bus.subscribe(handle_poller_connect, handle_poller_message)
+
+
+def handle_poller_connect():
+    """
+    Tells the poller which channels the clients are watching. Snapshots
+    asked for over an earlier connection are sent again on connecting
+    """
+    _requested_snapshots.clear()
+    send_watched_channels()
+
+
+def send_watched_channels():
+    """Tells the poller which channels the clients are watching"""
+    bus.send({
+        'type': 'watchers',
+        'channels': [
+            channel for channel in CHANNELS if audience.get_watchers(channel)]
+    })
+
+
+def handle_poller_message(message):
+    """
+    Stores the snapshot published by the poller and forwards the message to
+    every client. Patches only advance the version the poller is at, as
+    their snapshot is fetched once a client needs it
+    """
+    channel = message['channel']
+    if message.get('snapshot'):
+        snapshots.put(channel, message['snapshot'])
+        _poller_versions[channel] = message['snapshot']['version']
+    if message['type'] == 'snapshot':
+        _requested_snapshots.discard(channel)
+    elif 'version' in message['payload']:
+        _poller_versions[channel] = message['payload']['version']
+    elif message['event'] == 'stale':
+        snapshots.mark_stale(channel, message['payload']['since'])
+    if getattr(socketio, 'server', None) is None:
+        # Clients get the snapshots once the server is running
+        return
+
+    if message['type'] == 'emit':
+        count_emit(
+            channel, message['event'], len(json.dumps(message['payload'])))
+        send_to_clients(
+            channel, message['event'], message['payload'],
+            message.get('frame'))
+    elif message['type'] == 'snapshot' and message['snapshot']:
+        payload, size, frame = get_snapshot_message(message['snapshot'])
+        count_emit(channel, 'snapshot', size)
+        send_to_clients(channel, channel, payload, frame)
+
+
+def set_channels_idle(idle_channels, idle):
+    """
+    Switches the refresh jobs of the channels between their regular and
+    idle intervals. Jobs that become active are refreshed immediately.
+    Front ends don't run the jobs, and tell the poller instead
+    """
+    if bus.role == bus.FRONTEND:
+        if idle_channels:
+            send_watched_channels()
+        return
+    for module, update, channel, interval in REFRESH_JOBS:
+        if channel in idle_channels and scheduler.get_job(module):
+            scheduler.set_idle(module, idle)
+            set_module_idle(module, idle)
+
+
+def set_module_idle(module, idle):
+    """
+    Pauses or resumes the work that a loaded module does between refreshes,
+    for modules that do any
+    """
+    if hasattr(modules.get(module), 'set_idle'):
+        modules[module].set_idle(idle)
+
+
+def get_client_id():
+    """Returns the session id of the current SocketIO client"""
+    return request.namespace.socket.sessid
 
 
 @socketio.on('connect')
 def client_connect():
     """
-    Send the current information via SocketIO to new clients as
-    they connect to the server
+    Send the latest snapshot of each channel via SocketIO to new clients as
+    they connect to the server, without contacting any upstream servers.
+    Channels that nobody was watching are refreshed right away
+    """
+    if get_client_id() not in _deflate_clients:
+        join_room(PLAIN_ROOM)
+    for channel in CHANNELS:
+        send_snapshot(channel)
+    set_channels_idle(audience.watch(get_client_id(), CHANNELS), False)
+
+
+@socketio.on('disconnect')
+def client_disconnect():
+    """Lets the channels the client was the last watcher of go idle"""
+    _deflate_clients.discard(get_client_id())
+    set_channels_idle(audience.disconnect(get_client_id()), True)
+
+
+@socketio.on('compression')
+def client_compression(method):
+    """
+    Switches a client that can inflate messages over to deflated messages.
+    Clients ask for this before connecting
+    """
+    if method == 'deflate':
+        _deflate_clients.add(get_client_id())
+        leave_room(PLAIN_ROOM)
+        join_room(DEFLATE_ROOM)
+
+
+@socketio.on('watch')
+def client_watch(channels):
+    """
+    Marks the channels as watched by the client, sending their latest
+    snapshots and refreshing any that nobody was watching
+    """
+    channels = [channel for channel in channels if channel in CHANNELS]
+    for channel in channels:
+        send_snapshot(channel)
+    set_channels_idle(audience.watch(get_client_id(), channels), False)
+
+
+@socketio.on('unwatch')
+def client_unwatch(channels):
+    """
+    Marks the channels as no longer watched by the client, letting those
+    without any other watchers go idle
+    """
+    channels = [channel for channel in channels if channel in CHANNELS]
+    set_channels_idle(audience.unwatch(get_client_id(), channels), True)
+
+
+@socketio.on('resync')
+def client_resync(channel):
+    """
+    Resends the full snapshot of a channel to a client that missed a patch
+    """
+    if channel in CHANNELS:
+        send_snapshot(channel)
+
+
+def request_snapshot(channel):
+    """
+    Asks the poller for the latest snapshot of the channel, which is sent
+    to every client once it arrives
+    """
+    if channel not in _requested_snapshots:
+        _requested_snapshots.add(channel)
+        bus.send({'type': 'snapshot_request', 'channel': channel})
+
+
+def send_snapshot(channel):
+    """
+    Sends the latest snapshot of the channel to the current client. A front
+    end that only holds an older version than the poller asks for it instead
     """
-    emit('plex', {
-        'data': recently_released() if not now_playing() else now_playing()})
-    emit('forecast', {'data': forecast()})
-    emit('bandwidth', {'data': bandwidth()})
-    emit('services', {'data': services()})
-    emit('volumes', {'data': volumes()})
+    if snapshots.get_version(channel) < _poller_versions.get(channel, 0):
+        request_snapshot(channel)
+        return
+    snapshot = snapshots.get(channel)
+    if snapshot:
+        payload, size, frame = get_snapshot_message(snapshot)
+        count_emit(channel, 'snapshot', size)
+        if frame is not None and get_client_id() in _deflate_clients:
+            emit_compressed_bytes.inc(len(frame), channel=channel)
+            emit(channel, {'deflate': frame})
+        else:
+            emit(channel, payload)
@@ -0,0 +1,311 @@
+"""
+Contains the store that keeps the history of the values shown on the status
+page, such as bandwidth, ping times, volume usage and service uptime
+"""
+
+from __future__ import division
+
+import logging
+import os
+import sqlite3
+import time
+
+import gevent
+from gevent.event import Event
+from gevent.threadpool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryStore:
+    """
+    An append-only store of time series backed by SQLite in WAL mode.
+    Samples are buffered in memory and written in batches by a single
+    background thread, so recording a sample never blocks a greenlet. Each
+    sample is also added to rollups by minute and by hour, which is what
+    queries read from, and every table is pruned to its retention.
+
+    Queries run on a read-only connection on a second thread so that they
+    never wait behind a batch being written. The aggregates shown on the
+    status page are served from memory and recomputed in the background
+    """
+    ROLLUPS = (('1m', 60), ('1h', 3600))
+    _PRUNE_INTERVAL = 3600
+
+    def __init__(self, **kwargs):
+        """Initializes the store with the default settings"""
+        self.configure(**kwargs)
+
+    def configure(
+            self, path=None, flush_interval=5, max_pending=10000,
+            raw_retention=24 * 60 * 60, minute_retention=7 * 24 * 60 * 60,
+            hour_retention=365 * 24 * 60 * 60, aggregate_interval=60,
+            **kwargs):
+        """
+        Sets the location, batching and retention in seconds of the store.
+        Without a path nothing is recorded. Up to max_pending samples are
+        buffered between batches, after which the oldest are dropped. The
+        aggregates are recomputed every aggregate_interval seconds
+        """
+        self._path = path
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._retention = {
+            'samples': raw_retention,
+            'rollup_1m': minute_retention,
+            'rollup_1h': hour_retention
+        }
+        self._aggregate_interval = aggregate_interval
+        self._pending = []
+        self._pool = None
+        self._connection = None
+        self._reader_pool = None
+        self._reader = None
+        self._aggregates = {}
+        self._aggregate_series = {}
+        self._new_series = Event()
+        self._last_prune = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.last_batch_duration = None
+        self.aggregates_updated = None
+
+    def start(self):
+        """
+        Opens the database on the background threads and starts writing
+        batches to it and recomputing the aggregates
+        """
+        if not self._path or self._pool is not None:
+            return
+        self._pool = ThreadPool(1)
+        self._pool.apply(self.open)
+        self._reader_pool = ThreadPool(1)
+        self._reader_pool.apply(self.open_reader)
+        gevent.spawn(self.flush_forever)
+        gevent.spawn(self.aggregate_forever)
+
+    def open(self):
+        """Connects to the database and creates its tables"""
+        directory = os.path.dirname(self._path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._connection = sqlite3.connect(self._path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS samples '
+            '(series TEXT NOT NULL, time INTEGER NOT NULL, value REAL)')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS samples_series_time '
+            'ON samples (series, time)')
+        for name, seconds in HistoryStore.ROLLUPS:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS rollup_{} ('
+                'series TEXT NOT NULL, time INTEGER NOT NULL, '
+                'count INTEGER, sum REAL, min REAL, max REAL, '
+                'PRIMARY KEY (series, time))'.format(name))
+        self._connection.commit()
+
+    def open_reader(self):
+        """
+        Opens the read-only connection that queries run on. In WAL mode it
+        reads the last committed batch while the next one is written
+        """
+        self._reader = sqlite3.connect(self._path)
+        self._reader.execute('PRAGMA query_only=ON')
+
+    def record(self, series, value, timestamp=None):
+        """Buffers a sample of the series to be written in the next batch"""
+        if not self._path or value is None:
+            return
+        self._pending.append(
+            (series, int(timestamp or time.time()), float(value)))
+        if len(self._pending) > self._max_pending:
+            del self._pending[0]
+            self.dropped += 1
+
+    def flush_forever(self):
+        """Writes the buffered samples every flush_interval seconds"""
+        while True:
+            gevent.sleep(self._flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to write the history')
+
+    def flush(self):
+        """
+        Writes the buffered samples on the background thread, waiting for
+        the write without blocking any other greenlet
+        """
+        batch, self._pending = self._pending, []
+        if batch:
+            self._pool.apply(self.write_batch, (batch,))
+
+    def write_batch(self, batch):
+        """
+        Inserts the samples and adds them to the rollups in a single
+        transaction. Runs on the background thread
+        """
+        start = time.time()
+        rollups = {}
+        for series, timestamp, value in batch:
+            for name, seconds in HistoryStore.ROLLUPS:
+                key = (name, series, timestamp - timestamp % seconds)
+                rollup = rollups.get(key)
+                if rollup is None:
+                    rollups[key] = [1, value, value, value]
+                else:
+                    rollup[0] += 1
+                    rollup[1] += value
+                    rollup[2] = min(rollup[2], value)
+                    rollup[3] = max(rollup[3], value)
+
+        with self._connection:
+            self._connection.executemany(
+                'INSERT INTO samples (series, time, value) VALUES (?, ?, ?)',
+                batch)
+            for (name, series, bucket), (count, total, low, high) in (
+                    rollups.items()):
+                self._connection.execute(
+                    'INSERT OR IGNORE INTO rollup_{} '
+                    '(series, time, count, sum, min, max) '
+                    'VALUES (?, ?, 0, 0, ?, ?)'.format(name),
+                    (series, bucket, low, high))
+                self._connection.execute(
+                    'UPDATE rollup_{} SET count = count + ?, sum = sum + ?, '
+                    'min = MIN(min, ?), max = MAX(max, ?) '
+                    'WHERE series = ? AND time = ?'.format(name),
+                    (count, total, low, high, series, bucket))
+
+        if time.time() - self._last_prune > HistoryStore._PRUNE_INTERVAL:
+            self.prune()
+        self.written += len(batch)
+        self.batches += 1
+        self.last_batch_duration = time.time() - start
+
+    def prune(self):
+        """
+        Deletes everything older than the retention of its table. Runs on the
+        background thread
+        """
+        now = time.time()
+        with self._connection:
+            for table, retention in self._retention.items():
+                self._connection.execute(
+                    'DELETE FROM {} WHERE time < ?'.format(table),
+                    (int(now - retention),))
+        self._last_prune = now
+
+    def read(self, sql, parameters):
+        """Runs the query on the reader thread and returns its rows"""
+        if self._reader_pool is None:
+            return []
+        return self._reader_pool.apply(
+            lambda: self._reader.execute(sql, parameters).fetchall())
+
+    def query(self, series, start=None, end=None, resolution=None):
+        """
+        Returns the minimum, maximum and average of the series in each
+        interval between start and end, which default to the last day. The
+        resolution is '1m', '1h' or 'raw', and is chosen from the length of
+        the window when it isn't provided
+        """
+        end = end or time.time()
+        start = start or end - 24 * 60 * 60
+        if resolution is None:
+            resolution = '1m' if end - start <= 6 * 60 * 60 else '1h'
+
+        if resolution == 'raw':
+            rows = self.read(
+                'SELECT time, 1, value, value, value FROM samples '
+                'WHERE series = ? AND time >= ? AND time <= ? ORDER BY time',
+                (series, int(start), int(end)))
+        elif resolution in dict(HistoryStore.ROLLUPS):
+            rows = self.read(
+                'SELECT time, count, sum, min, max FROM rollup_{} '
+                'WHERE series = ? AND time >= ? AND time <= ? '
+                'ORDER BY time'.format(resolution),
+                (series, int(start), int(end)))
+        else:
+            raise ValueError('Unknown resolution {}'.format(resolution))
+
+        return [{
+            'time': bucket,
+            'count': count,
+            'avg': total / count if count else None,
+            'min': low,
+            'max': high
+        } for bucket, count, total, low, high in rows]
+
+    def get_aggregates(self, series, window=24 * 60 * 60):
+        """
+        Returns the minimum, maximum and average of each of the series over
+        the last window seconds as last computed, without reading the
+        database. Series that haven't been asked for before are computed
+        by the background greenlet right away, and are missing until then
+        """
+        wanted = self._aggregate_series.setdefault(window, set())
+        if not wanted.issuperset(series):
+            wanted.update(series)
+            self._new_series.set()
+        cached = self._aggregates.get(window, {})
+        return dict(
+            (name, cached[name]) for name in series if name in cached)
+
+    def aggregate_forever(self):
+        """
+        Recomputes the aggregates every aggregate_interval seconds, and as
+        soon as new series are asked for
+        """
+        while True:
+            self._new_series.wait(self._aggregate_interval)
+            self._new_series.clear()
+            try:
+                self.update_aggregates()
+            except Exception:
+                logger.exception('Failed to compute the history aggregates')
+
+    def update_aggregates(self):
+        """Recomputes the aggregates of every series asked for"""
+        for window, series in list(self._aggregate_series.items()):
+            self._aggregates[window] = self.read_aggregates(
+                sorted(series), window)
+        self.aggregates_updated = time.time()
+
+    def read_aggregates(self, series, window):
+        """
+        Returns the minimum, maximum and average of each of the series over
+        the last window seconds, read from the hourly rollups
+        """
+        if not series:
+            return {}
+        rows = self.read(
+            'SELECT series, SUM(count), SUM(sum), MIN(min), MAX(max) '
+            'FROM rollup_1h WHERE time >= ? AND series IN ({}) '
+            'GROUP BY series'.format(', '.join('?' * len(series))),
+            [int(time.time() - window)] + list(series))
+        return dict((name, {
+            'count': count,
+            'avg': total / count if count else None,
+            'min': low,
+            'max': high
+        }) for name, count, total, low, high in rows)
+
+    def get_series(self):
+        """Returns the names of every series with recent history"""
+        return [row[0] for row in self.read(
+            'SELECT DISTINCT series FROM rollup_1h ORDER BY series', ())]
+
+    def get_stats(self):
+        """Returns the number of samples buffered, written and dropped"""
+        return {
+            'enabled': self._pool is not None,
+            'pending': len(self._pending),
+            'written': self.written,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'last_batch_duration': self.last_batch_duration,
+            'aggregates_updated': self.aggregates_updated
+        }
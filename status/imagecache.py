@@ -0,0 +1,225 @@
+"""
+Contains the content-addressed cache for the artwork proxied from Plex
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+
+from gevent.event import AsyncResult
+from status.connections import discard_response
+
+
+class ImageCache:
+    """
+    A two tier cache of images. Every image is stored on disk under the hash
+    of its content, which is also used as its ETag, and the disk tier is
+    kept under max_disk_bytes by evicting the least recently used images.
+    Small images that were recently used are also kept in memory
+    """
+    _CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, **kwargs):
+        """Initializes the cache with the default settings"""
+        self.configure(**kwargs)
+
+    def configure(
+            self, directory='cache/images', max_disk_bytes=256 * 1024 * 1024,
+            max_memory_bytes=16 * 1024 * 1024,
+            max_memory_image_bytes=512 * 1024, **kwargs):
+        """
+        Sets the location and size limits of the cache. Nothing is created
+        on disk until the first image is stored
+        """
+        self._blob_directory = os.path.join(directory, 'blobs')
+        self._key_directory = os.path.join(directory, 'keys')
+        self._max_disk_bytes = max_disk_bytes
+        self._max_memory_bytes = max_memory_bytes
+        self._max_memory_image_bytes = max_memory_image_bytes
+        self._disk_bytes = None
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._pending = {}
+        self.hits = {'memory': 0, 'disk': 0, 'miss': 0}
+
+    def get_key(self, url):
+        """Returns the key that the image at url is stored under"""
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def get_blob_path(self, digest):
+        """Returns the path of the file containing the image content"""
+        return os.path.join(self._blob_directory, digest[:2], digest)
+
+    def get_key_path(self, key):
+        """Returns the path of the file pointing a key to its content"""
+        return os.path.join(self._key_directory, key[:2], key)
+
+    def get(self, url):
+        """
+        Returns the cached image for url or None. The image is a dictionary
+        containing its etag, content_type and path, along with its content
+        if it is held in memory
+        """
+        key = self.get_key(url)
+        image = self._memory.pop(key, None)
+        if image is not None:
+            self._memory[key] = image
+            self.hits['memory'] += 1
+            return image
+
+        try:
+            with open(self.get_key_path(key), 'r') as key_file:
+                digest, content_type = key_file.read().split('\n', 1)
+            path = self.get_blob_path(digest)
+            # Touch the content so it becomes the most recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            self.hits['miss'] += 1
+            return None
+
+        self.hits['disk'] += 1
+        image = {'etag': digest, 'content_type': content_type, 'path': path}
+        self.remember(key, image)
+        return image
+
+    def get_or_fetch(self, url, fetch):
+        """
+        Returns the cached image for url, calling fetch to get a streamed
+        response for it on a miss. Concurrent misses for the same url share a
+        single fetch. Returns None if the image could not be fetched
+        """
+        image = self.get(url)
+        if image is not None:
+            return image
+
+        pending = self._pending.get(url)
+        if pending is not None:
+            return pending.get()
+
+        pending = self._pending[url] = AsyncResult()
+        try:
+            response = fetch()
+            try:
+                if response.status_code == 200:
+                    image = self.put(
+                        url, response.iter_content(ImageCache._CHUNK_SIZE),
+                        response.headers.get('Content-Type'))
+            finally:
+                if image is None:
+                    discard_response(response)
+                else:
+                    response.close()
+        finally:
+            del self._pending[url]
+            pending.set(image)
+        return image
+
+    def put(self, url, chunks, content_type):
+        """
+        Writes the image content from the iterable of chunks to disk,
+        without holding it all in memory, and returns the cached image
+        """
+        self.create_directories()
+        digest = hashlib.sha1()
+        size = 0
+        handle, temporary_path = tempfile.mkstemp(dir=self._blob_directory)
+        with os.fdopen(handle, 'wb') as blob_file:
+            for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                blob_file.write(chunk)
+        digest = digest.hexdigest()
+
+        path = self.get_blob_path(digest)
+        if os.path.exists(path):
+            os.remove(temporary_path)
+        else:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(temporary_path, path)
+            self._disk_bytes += size
+
+        key = self.get_key(url)
+        key_path = self.get_key_path(key)
+        if not os.path.isdir(os.path.dirname(key_path)):
+            os.makedirs(os.path.dirname(key_path))
+        with open(key_path, 'w') as key_file:
+            key_file.write('{}\n{}'.format(digest, content_type))
+
+        self.evict_disk()
+        image = {'etag': digest, 'content_type': content_type, 'path': path}
+        self.remember(key, image)
+        return image
+
+    def remember(self, key, image):
+        """
+        Loads the image content into memory if it is small enough, evicting
+        the least recently used images to stay under max_memory_bytes
+        """
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous['content'])
+
+        size = os.path.getsize(image['path'])
+        if size > self._max_memory_image_bytes:
+            return
+
+        with open(image['path'], 'rb') as blob_file:
+            image['content'] = blob_file.read()
+        self._memory[key] = image
+        self._memory_bytes += size
+        while self._memory_bytes > self._max_memory_bytes:
+            evicted_key, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted['content'])
+
+    def create_directories(self):
+        """Creates the cache directories and measures the disk usage"""
+        for directory in [self._blob_directory, self._key_directory]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(size for path, size, mtime in self.scan())
+
+    def scan(self):
+        """Returns the path, size and modification time of every blob"""
+        blobs = []
+        for root, directories, files in os.walk(self._blob_directory):
+            if root == self._blob_directory:
+                # Files directly in the blob directory are partial writes
+                continue
+            for name in files:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                blobs.append((path, stat.st_size, stat.st_mtime))
+        return blobs
+
+    def evict_disk(self):
+        """
+        Removes the least recently used images from disk until the disk tier
+        is under max_disk_bytes. Keys pointing at removed images become misses
+        """
+        if self._disk_bytes <= self._max_disk_bytes:
+            return
+
+        for path, size, mtime in sorted(self.scan(), key=lambda blob: blob[2]):
+            if self._disk_bytes <= self._max_disk_bytes:
+                break
+            os.remove(path)
+            self._disk_bytes -= size
+            for key, image in list(self._memory.items()):
+                if image['path'] == path:
+                    del self._memory[key]
+                    self._memory_bytes -= len(image['content'])
+
+    def get_stats(self):
+        """Returns the hit counters and sizes of both tiers"""
+        lookups = sum(self.hits.values())
+        return {
+            'hits': dict(self.hits),
+            'hit_rate': (
+                (self.hits['memory'] + self.hits['disk']) / float(lookups)
+                if lookups else None),
+            'memory_bytes': self._memory_bytes,
+            'disk_bytes': self._disk_bytes or 0
+        }
@@ -0,0 +1,114 @@
+"""
+Contains the index of the most recently added videos across the Plex library
+"""
+
+import heapq
+import logging
+
+from status.persistence import read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+
+class RecentlyAddedIndex:
+    """
+    Keeps the newest size videos across every library section in a min-heap
+    keyed by the time they were added, along with the addedAt cursor of each
+    section so that only videos added after it need to be fetched. The index
+    is saved to path after every change so it is warm after a restart
+    """
+
+    def __init__(self, size=10, path=None):
+        """Initializes the index, loading it from path if it exists"""
+        self._size = size
+        self._path = path
+        self._heap = []
+        self.cursors = {}
+        self.load()
+
+    def load(self):
+        """Loads the videos and cursors saved at path"""
+        saved = read_json(self._path)
+        if saved is None:
+            return
+        try:
+            self._heap = [
+                (entry['added_at'], entry['key'], entry['video'])
+                for entry in saved['videos']]
+            self.cursors = saved['cursors']
+        except (KeyError, TypeError):
+            logger.warning('Ignoring unreadable index %s', self._path)
+            self._heap = []
+            self.cursors = {}
+            return
+        heapq.heapify(self._heap)
+
+    def save(self):
+        """Writes the videos and cursors to path"""
+        if not self._path:
+            return
+        write_json(self._path, {
+            'cursors': self.cursors,
+            'videos': [
+                {'added_at': added_at, 'key': key, 'video': video}
+                for added_at, key, video in self._heap]
+        })
+
+    def get_cursor(self, section):
+        """
+        Returns the addedAt of the newest video seen in the section, or None
+        if the section has never been fetched
+        """
+        return self.cursors.get(section)
+
+    def get_minimum(self):
+        """
+        Returns the addedAt that a video must be newer than to be added to a
+        full index, or None while the index isn't full
+        """
+        if len(self._heap) < self._size:
+            return None
+        return self._heap[0][0]
+
+    def add(self, section, videos):
+        """
+        Adds the list of (added_at, key, video) tuples from the section,
+        dropping the oldest videos beyond size, and advances its cursor
+        """
+        keys = set(key for added_at, key, video in videos)
+        self._heap = [entry for entry in self._heap if entry[1] not in keys]
+        heapq.heapify(self._heap)
+        for entry in videos:
+            if len(self._heap) < self._size:
+                heapq.heappush(self._heap, entry)
+            elif entry[0] > self._heap[0][0]:
+                heapq.heapreplace(self._heap, entry)
+        if videos:
+            self.advance_cursor(
+                section, max(added_at for added_at, key, video in videos))
+
+    def advance_cursor(self, section, added_at):
+        """
+        Moves the cursor of the section up to added_at, for videos that were
+        fetched but are too old to be kept
+        """
+        self.cursors[section] = max(self.cursors.get(section) or 0, added_at)
+
+    def clear(self):
+        """Removes every video and cursor from the index"""
+        self._heap = []
+        self.cursors = {}
+
+    def get_videos(self):
+        """Returns the videos in the index from newest to oldest"""
+        return [
+            dict(video) for added_at, key, video in
+            sorted(self._heap, key=lambda entry: entry[0], reverse=True)]
+
+    def get_stats(self):
+        """Returns the size of the index and the cursor of each section"""
+        return {
+            'videos': len(self._heap),
+            'size': self._size,
+            'cursors': dict(self.cursors)
+        }
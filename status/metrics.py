@@ -0,0 +1,231 @@
+"""
+Contains the registry of the metrics describing how the status page is
+performing, which can be exported in the Prometheus text format
+"""
+
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import wraps
+import time
+
+
+def get_label_key(labels):
+    """Returns the key that the values for the labels are stored under"""
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    """Formats the labels of a sample in the Prometheus text format"""
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs))
+
+
+class Timer:
+    """
+    Measures how long its block or decorated function takes and records it
+    in a histogram
+    """
+
+    def __init__(self, histogram, labels):
+        """Initializes a timer recording into the histogram with labels"""
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        """Starts timing the block"""
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        """Records how long the block took, even if it raised"""
+        self._histogram.observe(time.time() - self._start, **self._labels)
+
+    def __call__(self, func):
+        """Times every call to func"""
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._histogram.observe(time.time() - start, **self._labels)
+        return timed
+
+
+class Counter:
+    """A value that only goes up, such as the number of errors"""
+    TYPE = 'counter'
+
+    def __init__(self, name, description):
+        """Initializes the counter without any values"""
+        self.name = name
+        self.description = description
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        """Increases the value for the labels by amount"""
+        key = get_label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """
+        Sets the value for the labels, for counters that are kept up to date
+        elsewhere
+        """
+        self._values[get_label_key(labels)] = value
+
+    def get(self, **labels):
+        """Returns the value for the labels"""
+        return self._values.get(get_label_key(labels), 0)
+
+    def get_samples(self):
+        """Returns the name, labels and value of every sample"""
+        return [
+            (self.name, format_labels(key), value)
+            for key, value in sorted(self._values.items())]
+
+    def get_stats(self):
+        """Returns the values keyed by their formatted labels"""
+        return dict(
+            (format_labels(key) or 'value', value)
+            for key, value in self._values.items())
+
+
+class Gauge(Counter):
+    """A value that can go up and down, such as the number of clients"""
+    TYPE = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        """Decreases the value for the labels by amount"""
+        self.inc(-amount, **labels)
+
+
+class Histogram:
+    """
+    Counts observations, such as durations in seconds, into cumulative
+    buckets along with their sum and count
+    """
+    TYPE = 'histogram'
+    DEFAULT_BUCKETS = (
+        0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        """Initializes the histogram without any observations"""
+        self.name = name
+        self.description = description
+        self._buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        """Records the value for the labels"""
+        key = get_label_key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            counts = self._values[key] = {
+                'buckets': [0] * (len(self._buckets) + 1),
+                'sum': 0.0,
+                'count': 0
+            }
+        counts['buckets'][bisect_left(self._buckets, value)] += 1
+        counts['sum'] += value
+        counts['count'] += 1
+
+    def time(self, **labels):
+        """
+        Returns a Timer recording into the histogram, for use as a context
+        manager or decorator
+        """
+        return Timer(self, labels)
+
+    def get_samples(self):
+        """Returns the name, labels and value of every sample"""
+        samples = []
+        for key, counts in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(
+                    self._buckets + ('+Inf',), counts['buckets']):
+                cumulative += count
+                samples.append((
+                    '{}_bucket'.format(self.name),
+                    format_labels(key, [('le', bound)]), cumulative))
+            samples.append((
+                '{}_sum'.format(self.name), format_labels(key), counts['sum']))
+            samples.append((
+                '{}_count'.format(self.name), format_labels(key),
+                counts['count']))
+        return samples
+
+    def get_stats(self):
+        """Returns the count, sum and mean of each set of labels"""
+        return dict(
+            (format_labels(key) or 'value', {
+                'count': counts['count'],
+                'sum': counts['sum'],
+                'mean': counts['sum'] / counts['count']
+            }) for key, counts in self._values.items())
+
+
+class MetricsRegistry:
+    """
+    Holds every metric by name. Collectors are called before the metrics are
+    read so that values kept elsewhere, such as by the scheduler, can be
+    copied into them
+    """
+
+    def __init__(self):
+        """Initializes the registry without any metrics"""
+        self._metrics = OrderedDict()
+        self._collectors = []
+
+    def register(self, metric_class, name, description, **kwargs):
+        """
+        Returns the metric registered under the name, creating it first if
+        needed
+        """
+        if name not in self._metrics:
+            self._metrics[name] = metric_class(name, description, **kwargs)
+        return self._metrics[name]
+
+    def counter(self, name, description):
+        """Returns the counter registered under the name"""
+        return self.register(Counter, name, description)
+
+    def gauge(self, name, description):
+        """Returns the gauge registered under the name"""
+        return self.register(Gauge, name, description)
+
+    def histogram(self, name, description, **kwargs):
+        """Returns the histogram registered under the name"""
+        return self.register(Histogram, name, description, **kwargs)
+
+    def add_collector(self, collector):
+        """Registers a function called before the metrics are read"""
+        self._collectors.append(collector)
+
+    def collect(self):
+        """Calls every collector and returns the metrics"""
+        for collector in self._collectors:
+            collector()
+        return self._metrics.values()
+
+    def to_prometheus(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.collect():
+            lines.append(
+                '# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.TYPE))
+            for name, labels, value in metric.get_samples():
+                lines.append(
+                    '{}{} {}'.format(name, labels, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def get_stats(self):
+        """Returns the values of every metric keyed by its name"""
+        return OrderedDict(
+            (metric.name, metric.get_stats()) for metric in self.collect())
@@ -0,0 +1,40 @@
+"""
+Contains the helpers that save state to JSON files, such as the caches that
+keep the page warm across restarts
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+def read_json(path):
+    """
+    Returns the value saved as JSON at path, or None if there is no such
+    file or it can't be read
+    """
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    except (IOError, ValueError):
+        logger.warning('Ignoring unreadable file %s', path)
+        return None
+
+
+def write_json(path, value):
+    """
+    Writes value to path as JSON, replacing the previous file only once it
+    has been written completely
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    handle, temporary_path = tempfile.mkstemp(dir=directory or '.')
+    with os.fdopen(handle, 'w') as json_file:
+        json.dump(value, json_file)
+    os.rename(temporary_path, path)
@@ -0,0 +1,109 @@
+"""
+Contains the streaming parser for the XML returned by Plex, along with the
+compact records it produces
+"""
+
+from xml.etree import ElementTree
+
+
+class Record(object):
+    """
+    A compact copy of an XML element, holding only the attributes named in
+    its __slots__ and the first child element of each type in CHILDREN.
+    Records can be read with get and find like the elements they replace
+    """
+    __slots__ = ('_children',)
+    TAG = None
+    CHILDREN = {}
+
+    def __init__(self, attributes):
+        """Copies the attributes of the element that the record needs"""
+        self._children = {}
+        for name in self.get_fields():
+            setattr(self, name, attributes.get(name))
+
+    @classmethod
+    def get_fields(cls):
+        """Returns the names of the attributes kept by the record"""
+        return [
+            name for name in cls.__slots__ if not name.startswith('_')]
+
+    def get(self, name, default=None):
+        """Returns the value of the attribute, or default if it isn't set"""
+        if name.startswith('_'):
+            return default
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def find(self, tag):
+        """Returns the first child record with the tag, or None"""
+        return self._children.get(tag)
+
+
+class PlexPlayer(Record):
+    """The device that a session is being played on"""
+    __slots__ = ('title', 'state')
+    TAG = 'Player'
+
+
+class PlexUser(Record):
+    """The user that a session is being played by"""
+    __slots__ = ('title',)
+    TAG = 'User'
+
+
+class PlexVideo(Record):
+    """
+    A video from a session, metadata or newest listing, with the attributes
+    used by Plex.process_currently_playing_video
+    """
+    __slots__ = (
+        'key', 'ratingKey', 'sessionKey', 'type', 'title', 'summary',
+        'thumb', 'grandparentThumb', 'grandparentTitle', 'parentIndex',
+        'index', 'duration', 'viewOffset', 'addedAt')
+    TAG = 'Video'
+    CHILDREN = {'Player': PlexPlayer, 'User': PlexUser}
+
+
+class PlexDirectory(Record):
+    """A library section"""
+    __slots__ = ('key',)
+    TAG = 'Directory'
+
+
+def iterparse_records(source, record_type, limit=None):
+    """
+    Incrementally parses the XML read from the file-like source, returning a
+    record of record_type for each matching child of the root element.
+    Parsing stops as soon as limit records have been collected, and every
+    element is discarded once it has been copied into a record so memory
+    use doesn't grow with the size of the response
+    """
+    records = []
+    record = None
+    root = None
+    depth = 0
+    for event, element in ElementTree.iterparse(
+            source, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if root is None:
+                root = element
+            elif depth == 2 and element.tag == record_type.TAG:
+                record = record_type(element.attrib)
+            elif (depth == 3 and record is not None and
+                    element.tag in record_type.CHILDREN and
+                    element.tag not in record._children):
+                record._children[element.tag] = (
+                    record_type.CHILDREN[element.tag](element.attrib))
+            continue
+
+        depth -= 1
+        if depth == 1:
+            if record is not None:
+                records.append(record)
+                record = None
+            root.clear()
+            if limit is not None and len(records) >= limit:
+                break
+    return records
@@ -0,0 +1,144 @@
+"""
+Contains the circuit breakers that protect the modules from failing
+upstream servers
+"""
+
+import time
+
+import gevent
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because its circuit breaker is open"""
+
+
+class CircuitTimeoutError(Exception):
+    """Raised when a call takes longer than its circuit breaker allows"""
+
+
+class CircuitBreaker:
+    """
+    Limits how long each call to an upstream server can take and stops
+    calling it after failure_threshold consecutive failures. Once
+    reset_timeout seconds have passed a single trial call is let through,
+    closing the circuit again if it succeeds
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(
+            self, name, timeout=None, failure_threshold=3, reset_timeout=30,
+            **kwargs):
+        """Initializes a closed circuit breaker"""
+        self.name = name
+        self._timeout = timeout
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.calls = 0
+        self.failures = 0
+        self.rejections = 0
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func unless the circuit is open, raising CircuitOpenError in
+        that case. Raises CircuitTimeoutError if the call takes too long
+        """
+        if self.state == CircuitBreaker.OPEN:
+            if time.time() - self.opened_at < self._reset_timeout:
+                self.rejections += 1
+                raise CircuitOpenError(
+                    '{} is unavailable, retrying in {:.0f}s'.format(
+                        self.name,
+                        self._reset_timeout - (time.time() - self.opened_at)))
+            self.state = CircuitBreaker.HALF_OPEN
+        elif self.state == CircuitBreaker.HALF_OPEN:
+            # Only the trial call is let through until it has finished
+            self.rejections += 1
+            raise CircuitOpenError('{} is being retried'.format(self.name))
+
+        self.calls += 1
+        succeeded = False
+        timeout = gevent.Timeout(self._timeout)
+        timeout.start()
+        try:
+            result = func(*args, **kwargs)
+            succeeded = True
+        except gevent.Timeout as error:
+            if error is not timeout:
+                raise
+            # gevent.Timeout isn't an Exception, so callers that only catch
+            # exceptions would be killed by it
+            raise CircuitTimeoutError('{} took longer than {}s'.format(
+                self.name, self._timeout))
+        finally:
+            timeout.cancel()
+            # Anything that interrupts the call, including being killed,
+            # counts as a failure so a trial call can't leave it half-open
+            if succeeded:
+                self.record_success()
+            else:
+                self.record_failure()
+        return result
+
+    def record_failure(self):
+        """Counts a failed call, opening the circuit if there are too many"""
+        self.failures += 1
+        self.consecutive_failures += 1
+        if (self.state == CircuitBreaker.HALF_OPEN or
+                self.consecutive_failures >= self._failure_threshold):
+            self.state = CircuitBreaker.OPEN
+            self.opened_at = time.time()
+
+    def record_success(self):
+        """Counts a successful call, closing the circuit"""
+        self.consecutive_failures = 0
+        self.state = CircuitBreaker.CLOSED
+        self.opened_at = None
+
+    def get_stats(self):
+        """Returns the state and counters of the circuit breaker"""
+        return {
+            'state': self.state,
+            'calls': self.calls,
+            'failures': self.failures,
+            'rejections': self.rejections,
+            'consecutive_failures': self.consecutive_failures,
+            'opened_at': self.opened_at
+        }
+
+
+class CircuitBreakers:
+    """
+    Holds one circuit breaker per upstream, created on first use with the
+    options configured for it
+    """
+
+    def __init__(self):
+        """Initializes the registry without any circuit breakers"""
+        self._breakers = {}
+        self._options = {}
+
+    def configure(self, **options):
+        """
+        Sets the options of each upstream's circuit breaker, keyed by the
+        name of the upstream
+        """
+        self._options = options
+        self._breakers = {}
+
+    def get(self, name):
+        """Returns the circuit breaker for the upstream"""
+        if name not in self._breakers:
+            self._breakers[name] = CircuitBreaker(
+                name, **self._options.get(name, {}))
+        return self._breakers[name]
+
+    def get_stats(self):
+        """Returns the state and counters of every circuit breaker"""
+        return dict(
+            (name, breaker.get_stats())
+            for name, breaker in self._breakers.items())
@@ -0,0 +1,185 @@
+"""
+Contains the scheduler that periodically runs the refresh job of each module
+"""
+
+from collections import OrderedDict
+import logging
+import random
+import time
+
+import gevent
+from gevent.event import Event
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """
+    A function that is run by the scheduler at a fixed rate, along with the
+    metrics describing how its runs went
+    """
+
+    def __init__(
+            self, name, func, interval, jitter=0, max_backoff=None,
+            start_delay=0, idle_interval=None):
+        """
+        Initializes the job. Each run starts up to jitter seconds after its
+        scheduled time, and runs after a failure are delayed exponentially up
+        to max_backoff seconds. While the job is idle it runs every
+        idle_interval seconds instead, or not at all if that is None
+        """
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.idle = False
+        self.jitter = jitter
+        self.max_backoff = max_backoff or interval * 32
+        self.start_delay = start_delay
+        self.wakeup = Event()
+        self.running = False
+        self.runs = 0
+        self.errors = 0
+        self.skipped = 0
+        self.consecutive_failures = 0
+        self.last_run = None
+        self.last_success = None
+        self.last_duration = None
+        self.last_lag = None
+        self.last_error = None
+
+    def get_interval(self):
+        """
+        Returns the current interval between runs, which is None when the job
+        is paused
+        """
+        return self.idle_interval if self.idle else self.interval
+
+    def get_backoff(self):
+        """Returns how long to wait after the latest consecutive failure"""
+        return min(
+            self.get_interval() * 2 ** self.consecutive_failures,
+            self.max_backoff)
+
+    def get_stats(self):
+        """Returns the metrics of the job"""
+        return {
+            'interval': self.interval,
+            'idle': self.idle,
+            'running': self.running,
+            'runs': self.runs,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'consecutive_failures': self.consecutive_failures,
+            'last_run': self.last_run,
+            'last_success': self.last_success,
+            'last_duration': self.last_duration,
+            'last_lag': self.last_lag,
+            'last_error': self.last_error
+        }
+
+
+class Scheduler:
+    """
+    Runs each registered job in its own greenlet at a fixed rate. A run that
+    takes longer than the interval causes the runs it overlapped to be
+    skipped rather than queued, and a failing job is retried with an
+    exponential backoff instead of at its usual rate
+    """
+
+    def __init__(self):
+        """Initializes a scheduler without any jobs"""
+        self._jobs = OrderedDict()
+        self._greenlets = {}
+
+    def add_job(self, name, func, interval, **kwargs):
+        """Registers func to be run every interval seconds once started"""
+        job = Job(name, func, interval, **kwargs)
+        self._jobs[name] = job
+        return job
+
+    def get_job(self, name):
+        """Returns the job registered under the name, or None"""
+        return self._jobs.get(name)
+
+    def start(self):
+        """Starts running every job that isn't already running"""
+        for name, job in self._jobs.items():
+            if name not in self._greenlets:
+                self._greenlets[name] = gevent.spawn(self.run_job, job)
+
+    def trigger(self, name):
+        """
+        Runs the job as soon as possible. If it is already running, a single
+        extra run follows the current one no matter how often it's triggered
+        """
+        self._jobs[name].wakeup.set()
+
+    def set_idle(self, name, idle):
+        """
+        Switches the job between its regular and idle intervals. A job that
+        becomes active again is triggered to run immediately
+        """
+        job = self._jobs[name]
+        if job.idle == idle:
+            return
+        job.idle = idle
+        if not idle:
+            job.wakeup.set()
+
+    def run_job(self, job):
+        """Runs the job forever, keeping to its schedule"""
+        scheduled = time.time() + job.start_delay
+        while True:
+            if job.get_interval() is None:
+                # Paused until the job is triggered or becomes active
+                triggered = job.wakeup.wait()
+                scheduled = time.time()
+            else:
+                start_at = scheduled + random.uniform(0, job.jitter)
+                triggered = job.wakeup.wait(max(start_at - time.time(), 0))
+            if triggered:
+                job.wakeup.clear()
+                start_at = time.time()
+
+            self.run_once(job, start_at)
+            if triggered and time.time() < scheduled:
+                # Runs triggered early keep the regularly scheduled run
+                continue
+
+            interval = job.get_interval()
+            if interval is None:
+                continue
+            scheduled += interval
+            now = time.time()
+            if scheduled < now:
+                missed = int((now - scheduled) // interval) + 1
+                job.skipped += missed
+                scheduled += missed * interval
+            if job.consecutive_failures:
+                scheduled = max(scheduled, job.last_run + job.get_backoff())
+
+    def run_once(self, job, start_at):
+        """Runs the job a single time and records its metrics"""
+        job.running = True
+        job.last_run = time.time()
+        job.last_lag = max(job.last_run - start_at, 0)
+        try:
+            job.func()
+        except (Exception, gevent.Timeout) as error:
+            job.errors += 1
+            job.consecutive_failures += 1
+            job.last_error = repr(error)
+            logger.exception('Job %s failed', job.name)
+        else:
+            job.consecutive_failures = 0
+            job.last_success = time.time()
+        finally:
+            job.runs += 1
+            job.running = False
+            job.last_duration = time.time() - job.last_run
+
+    def get_stats(self):
+        """Returns the metrics of every job"""
+        return OrderedDict(
+            (name, job.get_stats()) for name, job in self._jobs.items())
@@ -0,0 +1,129 @@
+"""
+Contains the SSH command runner used to communicate with remote hosts
+"""
+
+import re
+import socket
+
+from gevent.lock import BoundedSemaphore, Semaphore
+import paramiko
+
+
+_LINE_SEPARATOR = re.compile(r'[\r\n]+')
+
+
+class SSHCommandRunner:
+    """
+    Runs commands on a remote host over a single SSH transport. Each command
+    gets its own channel so that several commands can run at the same time,
+    and the transport is reconnected whenever it has died
+    """
+
+    def __init__(
+            self, hostname, username, password, max_channels=8, timeout=30,
+            port=22):
+        """Initializes the runner without connecting to the host"""
+        self._hostname = hostname
+        self._port = port
+        self._username = username
+        self._password = password
+        self._timeout = timeout
+        self._client = None
+        self._connect_lock = Semaphore()
+        self._channel_slots = BoundedSemaphore(max_channels)
+
+    def connect(self):
+        """Opens a new connection to the host, closing any existing one"""
+        self.close()
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            self._hostname, port=self._port, username=self._username,
+            password=self._password, timeout=self._timeout)
+        client.get_transport().set_keepalive(self._timeout)
+        self._client = client
+
+    def close(self):
+        """Closes the connection to the host"""
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def get_transport(self):
+        """
+        Returns the active transport to the host, reconnecting first if the
+        transport has died
+        """
+        with self._connect_lock:
+            transport = self._client.get_transport() if self._client else None
+            if transport is None or not transport.is_active():
+                self.connect()
+                transport = self._client.get_transport()
+            return transport
+
+    def close_transport(self, transport):
+        """
+        Closes the connection to the host if it still uses the transport,
+        leaving any connection that replaced it open
+        """
+        with self._connect_lock:
+            if (self._client is not None and
+                    self._client.get_transport() is transport):
+                self.close()
+
+    def open_session(self):
+        """
+        Opens a channel on the transport. A transport that fails to open it
+        is closed so that the next command reconnects, unless the host only
+        refused the channel, such as when too many are open
+        """
+        transport = self.get_transport()
+        try:
+            return transport.open_session()
+        except paramiko.ChannelException:
+            raise
+        except (paramiko.SSHException, socket.error):
+            self.close_transport(transport)
+            raise
+
+    def run(self, command, timeout=None):
+        """
+        Runs the command on its own channel and returns the lines that it
+        wrote to stdout
+        """
+        with self._channel_slots:
+            channel = self.open_session()
+            try:
+                channel.settimeout(timeout or self._timeout)
+                channel.exec_command(command)
+                return channel.makefile('r').readlines()
+            finally:
+                channel.close()
+
+    def stream(self, command, timeout=None):
+        """
+        Runs a long-lived command on its own channel and yields each line it
+        writes to stdout as soon as it arrives. Carriage returns are treated
+        as line breaks so that commands redrawing a single line can be read.
+        Raises socket.timeout if no output arrives within the timeout
+        """
+        with self._channel_slots:
+            channel = self.open_session()
+            try:
+                channel.settimeout(timeout or self._timeout)
+                channel.exec_command(command)
+                pending = ''
+                while True:
+                    data = channel.recv(4096)
+                    if not data:
+                        break
+                    lines = _LINE_SEPARATOR.split(
+                        pending + data.decode('utf-8', 'replace'))
+                    pending = lines.pop()
+                    for line in lines:
+                        if line:
+                            yield line
+                if pending:
+                    yield pending
+            finally:
+                channel.close()
@@ -0,0 +1,92 @@
+"""
+Contains the loader that creates the modules in the background
+"""
+
+import logging
+import time
+
+import gevent
+
+logger = logging.getLogger(__name__)
+
+
+class ModuleLoader:
+    """
+    Creates each module in its own greenlet so that a slow or unreachable
+    upstream server doesn't hold up the others, retrying failed modules
+    with an exponential backoff until they load
+    """
+
+    def __init__(self, modules, retry_interval=30, max_retry_interval=600):
+        """
+        Initializes the loader, which stores every module it creates in the
+        modules dictionary
+        """
+        self._modules = modules
+        self._retry_interval = retry_interval
+        self._max_retry_interval = max_retry_interval
+        self._states = {}
+        self._fresh = set()
+        self._greenlets = {}
+        self._ready_callbacks = []
+
+    def configure(self, retry_interval=30, max_retry_interval=600, **kwargs):
+        """Sets how long to wait before retrying a module that failed"""
+        self._retry_interval = retry_interval
+        self._max_retry_interval = max_retry_interval
+
+    def add_ready_callback(self, callback):
+        """Calls callback with the name of every module once it is loaded"""
+        self._ready_callbacks.append(callback)
+
+    def load(self, name, factory):
+        """Starts creating the module by calling factory in the background"""
+        self._states[name] = 'loading'
+        self._greenlets[name] = gevent.spawn(self.run_factory, name, factory)
+        return self._greenlets[name]
+
+    def run_factory(self, name, factory):
+        """Calls factory until it succeeds and stores the module it returns"""
+        delay = self._retry_interval
+        while True:
+            start = time.time()
+            try:
+                module = factory()
+            except Exception:
+                self._states[name] = 'unavailable'
+                logger.exception(
+                    'Failed to load %s after %.2fs, retrying in %ds',
+                    name, time.time() - start, delay)
+                gevent.sleep(delay)
+                delay = min(delay * 2, self._max_retry_interval)
+                continue
+
+            self._modules[name] = module
+            self._states[name] = 'ready'
+            self._fresh.add(name)
+            logger.info('Loaded %s in %.2fs', name, time.time() - start)
+            for callback in self._ready_callbacks:
+                callback(name)
+            return module
+
+    def get_state(self, name):
+        """Returns whether the module is loading, ready or unavailable"""
+        return self._states.get(name, 'loading')
+
+    def pop_fresh(self, name):
+        """
+        Returns whether the module has been loaded since this was last
+        called for it, meaning its data hasn't been published yet
+        """
+        if name in self._fresh:
+            self._fresh.discard(name)
+            return True
+        return False
+
+    def wait(self, timeout=None):
+        """Waits for every module to finish loading"""
+        gevent.joinall(list(self._greenlets.values()), timeout=timeout)
+
+    def get_stats(self):
+        """Returns the state of every module"""
+        return dict(self._states)
@@ -1,25 +1,106 @@
-function setupSocketIO() {
-	var socket = io.connect('http://' + document.domain + ':' + location.port);
+var panels = {
+	'plex': '#now_playing_wrapper',
+	'forecast': '#left_column_top',
+	'bandwidth': '#bandwidth',
+	'services': '#services',
+	'volumes': '#disk_space'
+};
 
-	socket.on('plex', function(msg) {
-		$('#now_playing_wrapper').html(msg['data']);
+var versions = {};
+
+function applyPatch(panel, patches) {
+	$.each(patches, function(key, fields) {
+		var record = $(panel).find('[data-key="' + key + '"]');
+		$.each(fields, function(field, value) {
+			record.find('[data-field="' + field + '"]').each(function() {
+				var element = $(this);
+				switch (element.data('apply')) {
+					case 'width':
+						element.css('width', value + '%');
+						break;
+					case 'icon':
+						element.attr('class', element.data('icon-' + value) || element.data('icon-default'));
+						break;
+					default:
+						element.text(value);
+				}
+			});
+			// Elements that only make sense with a value are always rendered,
+			// so that a patch can reveal them later
+			record.find('[data-visible="' + field + '"]').toggle(value !== null && value !== '');
+		});
 	});
+}
 
-	socket.on('forecast', function(msg) {
-		$('#left_column_top').html(msg['data']);
+function setStale(panel, since) {
+	// Stale panels keep showing the last data that could be fetched
+	if (since) {
+		$(panel).addClass('stale').attr('title', 'Last updated ' + new Date(since * 1000).toLocaleString());
+	} else {
+		$(panel).removeClass('stale').removeAttr('title');
+	}
+}
+
+var compression = window.DecompressionStream ? 'deflate' : null;
+var received = compression ? Promise.resolve() : null;
+
+function inflate(frame) {
+	var bytes = Uint8Array.from(atob(frame), function(c) {
+		return c.charCodeAt(0);
 	});
+	var stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate'));
+	return new Response(stream).text().then(JSON.parse);
+}
+
+function onMessage(socket, event, handler) {
+	if (!compression) {
+		socket.on(event, handler);
+		return;
+	}
+	socket.on(event, function(msg) {
+		// Messages are handled in the order they arrived, so a patch is never
+		// applied before the deflated panel it was based on
+		received = received.then(function() {
+			return msg && msg['deflate'] ? inflate(msg['deflate']) : msg;
+		}).then(handler).catch(function(error) {
+			console.error('Failed to handle ' + event, error);
+		});
+	});
+}
+
+function setupSocketIO() {
+	var socket = io.connect('http://' + document.domain + ':' + location.port);
+
+	$.each(panels, function(channel, panel) {
+		onMessage(socket, channel, function(msg) {
+			$(panel).html(msg['data']);
+			versions[channel] = msg['version'];
+			setStale(panel, msg['stale_since']);
+		});
 
-	socket.on('bandwidth', function(msg) {
-		$('#bandwidth').html(msg['data']);
+		onMessage(socket, channel + '_patch', function(msg) {
+			if (versions[channel] !== msg['base']) {
+				// A patch was missed, so the full panel is needed again
+				socket.emit('resync', channel);
+				return;
+			}
+			applyPatch(panel, msg['patches']);
+			versions[channel] = msg['version'];
+		});
 	});
 
-	socket.on('services', function(msg) {
-		$('#services').html(msg['data']);
+	onMessage(socket, 'stale', function(msg) {
+		setStale(panels[msg['channel']], msg['since']);
 	});
 
-	socket.on('volumes', function(msg) {
-		$('#disk_space').html(msg['data']);
+	// Hidden tabs stop watching so that idle channels can stop polling
+	$(document).on('visibilitychange', function() {
+		socket.emit(document.hidden ? 'unwatch' : 'watch', Object.keys(panels));
 	});
 
+	// Asked for before connecting so that the first snapshots are deflated
+	if (compression) {
+		socket.emit('compression', compression);
+	}
 	socket.emit('connect');
 }
@@ -0,0 +1,86 @@
+"""
+Contains the fixed-size ring buffers used to keep a short history of samples
+"""
+
+from __future__ import division
+
+from array import array
+import math
+
+_SPARK_CHARACTERS = u'\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+
+class RingBuffer:
+    """
+    A fixed-size buffer of float samples backed by an array. Once the buffer
+    is full, each new sample overwrites the oldest one
+    """
+
+    def __init__(self, size):
+        """Initializes an empty buffer that holds up to size samples"""
+        self._samples = array('d', [0.0] * size)
+        self._size = size
+        self._next = 0
+        self._count = 0
+
+    def append(self, value):
+        """Adds a sample to the buffer, replacing the oldest if it is full"""
+        self._samples[self._next] = value
+        self._next = (self._next + 1) % self._size
+        self._count = min(self._count + 1, self._size)
+
+    def __len__(self):
+        """Returns the number of samples in the buffer"""
+        return self._count
+
+    def values(self, count=None):
+        """
+        Returns the most recent count samples (or all of them) from oldest
+        to newest
+        """
+        count = self._count if count is None else min(count, self._count)
+        start = (self._next - count) % self._size
+        if start + count <= self._size:
+            return self._samples[start:start + count].tolist()
+        return (self._samples[start:].tolist() +
+                self._samples[:self._next].tolist())
+
+    def mean(self, count=None):
+        """Returns the mean of the most recent count samples, or None"""
+        samples = self.values(count)
+        if not samples:
+            return None
+        return sum(samples) / len(samples)
+
+    def get_summary(self):
+        """
+        Returns a dictionary containing the minimum, average and 95th
+        percentile of the samples in the buffer, or None if it is empty
+        """
+        samples = sorted(self.values())
+        if not samples:
+            return None
+        p95_index = max(int(math.ceil(0.95 * len(samples))) - 1, 0)
+        return {
+            'min': samples[0],
+            'avg': sum(samples) / len(samples),
+            'p95': samples[p95_index]
+        }
+
+    def get_sparkline(self, width=30):
+        """
+        Returns a string of block characters showing the samples in the
+        buffer, averaged down to at most width characters
+        """
+        samples = self.values()
+        if not samples:
+            return u''
+        bucket_size = int(math.ceil(len(samples) / width))
+        buckets = [
+            sum(samples[i:i + bucket_size]) / len(samples[i:i + bucket_size])
+            for i in range(0, len(samples), bucket_size)]
+        highest = max(buckets) or 1
+        levels = len(_SPARK_CHARACTERS) - 1
+        return u''.join(
+            _SPARK_CHARACTERS[int(round(levels * value / highest))]
+            for value in buckets)
@@ -1,11 +1,21 @@
 """Contains the Flask views"""
 
-from flask import render_template, request, make_response
+from flask import (Response, abort, jsonify, render_template, request,
+                   make_response, send_file)
+import gevent
+import requests
 
-from status import app
+from status import app, metrics
+from status.resilience import CircuitOpenError
 
 import status
 
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+IMAGE_VARIANT_LIMITS = {'width': 2048, 'height': 2048, 'quality': 100}
+
+render_seconds = metrics.histogram(
+    'status_render_seconds', 'Time spent rendering each template')
+
 
 @app.route('/')
 def home():
@@ -15,56 +25,249 @@ def home():
 
 @app.route('/image/')
 def fetch_image():
-    """Loads and returns the requested image"""
+    """
+    Loads and returns the requested image from the image cache, fetching it
+    from Plex on a miss. The optional width, height and quality arguments
+    select a scaled down variant of the image, which is cached separately.
+    The quality only applies to scaled images, so it is ignored without a
+    width or height rather than caching the original image twice
+    """
     url = request.args.get('image')
-    req = status.modules['plex'].get_image_from_plex(url)
-    response = make_response(req.content)
-    response.headers['Content-Type'] = req.headers['Content-Type']
+    variant = dict(
+        (name, get_bounded_arg(name, maximum))
+        for name, maximum in IMAGE_VARIANT_LIMITS.items())
+    if not (variant['width'] or variant['height']):
+        variant['quality'] = None
+    key = '{}?{}'.format(url, '&'.join(
+        '{}={}'.format(name, variant[name]) for name in sorted(variant)
+        if variant[name]))
+    try:
+        image = status.image_cache.get_or_fetch(
+            key, lambda: status.breakers.get('plex').call(
+                status.modules['plex'].get_image_from_plex, url, **variant))
+    except CircuitOpenError:
+        abort(503)
+    except (Exception, gevent.Timeout):
+        abort(502)
+    if image is None:
+        abort(502)
+
+    if request.if_none_match.contains(image['etag']):
+        response = make_response('', 304)
+    elif 'content' in image:
+        response = make_response(image['content'])
+        response.headers['Content-Type'] = image['content_type']
+    else:
+        response = send_file(
+            image['path'], mimetype=image['content_type'], add_etags=False)
+
+    response.set_etag(image['etag'])
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_MAX_AGE
     return response
 
 
-def now_playing():
+def get_bounded_arg(name, maximum):
+    """
+    Returns the named request argument as an integer between 1 and maximum,
+    or None if it is missing or invalid
+    """
+    value = request.args.get(name, type=int)
+    if not value or value < 1:
+        return None
+    return min(value, maximum)
+
+
+@app.route('/stats/images')
+def image_stats():
+    """Returns the hit counters and sizes of the image cache"""
+    return jsonify(status.image_cache.get_stats())
+
+
+@app.route('/stats/connections')
+def connection_stats():
+    """Returns the request and connection counts for each upstream host"""
+    return jsonify(status.http_pool.get_stats())
+
+
+@app.route('/stats/channels')
+def channel_stats():
+    """Returns the render counters for each channel"""
+    return jsonify(dict(
+        (name, channel.get_stats())
+        for name, channel in status.functions.channels.items()))
+
+
+@app.route('/stats/scheduler')
+def scheduler_stats():
+    """Returns the run time and lag metrics for each refresh job"""
+    return jsonify(status.scheduler.get_stats())
+
+
+@app.route('/stats/modules')
+def module_stats():
+    """Returns whether each module is loading, ready or unavailable"""
+    return jsonify(status.module_loader.get_stats())
+
+
+@app.route('/stats/breakers')
+def breaker_stats():
+    """Returns the state and counters of each circuit breaker"""
+    return jsonify(status.breakers.get_stats())
+
+
+@app.route('/stats/audience')
+def audience_stats():
+    """Returns the number of connected clients and channel watchers"""
+    return jsonify(status.audience.get_stats())
+
+
+@app.route('/stats/forecast')
+def forecast_stats():
+    """Returns the age of the forecast and the API calls made today"""
+    if status.module_loader.get_state('forecast') != 'ready':
+        abort(503)
+    return jsonify(status.modules['forecast'].get_stats())
+
+
+@app.route('/stats/recently_released')
+def recently_released_stats():
+    """Returns the size and section cursors of the recently released index"""
+    if status.module_loader.get_state('plex') != 'ready':
+        abort(503)
+    return jsonify(status.modules['plex'].get_index_stats())
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Returns every metric in the Prometheus text format"""
+    return Response(
+        metrics.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/stats/metrics')
+def metric_stats():
+    """Returns every metric as JSON"""
+    return jsonify(metrics.get_stats())
+
+
+@app.route('/history/')
+def history_series():
+    """Returns the names of the series with recorded history"""
+    return jsonify(
+        series=status.history.get_series(),
+        stats=status.history.get_stats())
+
+
+@app.route('/history/<path:series>')
+def history_query(series):
+    """
+    Returns the aggregates of the series in each interval between the start
+    and end timestamps, at the requested resolution of 1m, 1h or raw
+    """
+    try:
+        points = status.history.query(
+            series,
+            start=request.args.get('start', type=float),
+            end=request.args.get('end', type=float),
+            resolution=request.args.get('resolution'))
+    except ValueError:
+        abort(400)
+    return jsonify(series=series, points=points)
+
+
+@app.route('/volumes/<host>/<volume>/datasets')
+def volume_datasets(host, volume):
+    """
+    Returns a page of the datasets of a FreeNAS volume, starting at the
+    offset argument and holding up to limit datasets
+    """
+    if status.module_loader.get_state('freenas') != 'ready':
+        abort(503)
+    if not status.modules['freenas'].has_volume(host, volume):
+        abort(404)
+    try:
+        page = status.modules['freenas'].get_datasets(
+            host, volume,
+            offset=request.args.get('offset', 0, type=int),
+            limit=request.args.get('limit', 50, type=int))
+    except (requests.RequestException, ValueError):
+        abort(502)
+    return jsonify(page)
+
+
+@app.route('/stats/bus')
+def bus_stats():
+    """Returns the role of the process and its message bus counters"""
+    return jsonify(status.bus.get_stats())
+
+
+def render(template, **context):
+    """Renders the template, recording how long it took"""
+    with render_seconds.time(template=template):
+        return render_template(template, **context)
+
+
+def now_playing(videos=None):
     """Renders the now playing portion of the network status page"""
-    videos = status.modules['plex'].get_currently_playing_videos()
+    if videos is None:
+        videos = status.modules['plex'].get_currently_playing_videos()
     if not videos:
         return False
-    return render_template('now_playing.html', videos=videos)
+    return render('now_playing.html', videos=videos)
 
 
-def recently_released():
+def recently_released(videos=None):
     """Renders the recently released portion of the network status page"""
-    videos = status.modules['plex'].get_recently_released_videos()
-    return render_template('recently_released.html', videos=videos)
+    if videos is None:
+        videos = status.modules['plex'].get_recently_released_videos()
+    return render('recently_released.html', videos=videos)
 
 
-def forecast():
+def forecast(weather=None):
     """Renders the forecast portion of the network status page"""
-    weather = status.modules['forecast'].get_forecast()
-    return render_template('forecast.html', weather=weather)
+    if weather is None:
+        weather = status.modules['forecast'].get_forecast()
+    return render('forecast.html', weather=weather)
 
 
-def bandwidth():
+def bandwidth(interfaces=None):
     """Renders the bandwidth portion of the network status page"""
-    interfaces = status.modules['pfsense'].get_interfaces()
-    return render_template('bandwidth.html', interfaces=interfaces)
+    if interfaces is None:
+        interfaces = status.modules['pfsense'].get_interfaces()
+    return render('bandwidth.html', interfaces=interfaces)
 
 
-def services():
+def services(service_list=None):
     """Renders the services portion of the network status page"""
-    service_list = status.modules['services'].get_status()
-    return render_template('services.html', service_list=service_list)
+    if service_list is None:
+        service_list = status.modules['services'].get_status()
+    return render('services.html', service_list=service_list)
 
 
-def volumes():
+def get_volume_info():
+    """Returns the details about all volumes needed to render them"""
+    return {
+        'volume_list': status.modules['freenas'].get_volumes(),
+        'total_space_avail': status.modules['freenas'].get_total_avail(),
+        'total_space': status.modules['freenas'].get_total_space(),
+        'total_percent_used': status.modules['freenas'].get_percent_used()
+    }
+
+
+def volumes(volume_info=None):
     """Renders the volumes portion of the network status page"""
-    volume_list = status.modules['freenas'].get_volumes()
-    return render_template(
-        'volumes.html',
-        volume_list=volume_list,
-        total_space_avail=status.modules['freenas'].get_total_avail(),
-        total_space=status.modules['freenas'].get_total_space(),
-        total_percent_used=status.modules['freenas'].get_percent_used()
-    )
+    if volume_info is None:
+        volume_info = get_volume_info()
+    return render('volumes.html', **volume_info)
+
+
+def module_state(state):
+    """
+    Renders the placeholder shown in place of a module that is loading or
+    unavailable
+    """
+    return render('module_state.html', state=state)
 
 
 @app.template_filter('strftime')
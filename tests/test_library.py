@@ -0,0 +1,127 @@
+"""
+Tests that the recently added index picks up every new video, including
+old releases that were only just added to the library
+"""
+
+import unittest
+
+from status.functions import Plex
+from status.library import RecentlyAddedIndex
+
+
+class FakeSection:
+    """
+    A Plex library section holding (key, added_at) videos. Like Plex, it
+    lists them by release date unless asked to sort them by addedAt
+    """
+
+    def __init__(self, videos):
+        """Initializes the section with videos ordered by release date"""
+        self.videos = list(videos)
+        self.requests = []
+
+    def fetch_xml(self, url, params=None, limit=None):
+        """Returns the window of videos selected by the container params"""
+        self.requests.append((url, params))
+        videos = self.videos
+        if params.get('sort') == 'addedAt:desc':
+            videos = sorted(
+                videos, key=lambda video: int(video['addedAt']),
+                reverse=True)
+        start = params['X-Plex-Container-Start']
+        return videos[start:start + params['X-Plex-Container-Size']]
+
+
+def make_video(key, added_at):
+    """Returns a listed video with the key and addedAt"""
+    return {'ratingKey': key, 'addedAt': str(added_at)}
+
+
+def make_plex(index, section):
+    """Returns a Plex that lists the section without contacting a server"""
+    plex = Plex.__new__(Plex)
+    plex._server = 'http://plex'
+    plex._index = index
+    plex._index_size = index._size
+    plex.fetch_xml = section.fetch_xml
+    return plex
+
+
+def add_videos(index, section_key, videos):
+    """Adds the fetched videos to the index the way Plex does"""
+    index.add(section_key, [
+        (int(video['addedAt']), video['ratingKey'], video)
+        for video in videos])
+
+
+class FetchNewestTest(unittest.TestCase):
+    """Tests fetching the videos added to a section since the last fetch"""
+
+    def setUp(self):
+        """Creates a section where release and added dates interleave"""
+        # Ordered by release date, newest release first
+        self.section = FakeSection([
+            make_video('new-release', 300),
+            make_video('recent-release', 100),
+            make_video('old-release', 200),
+            make_video('classic', 50)
+        ])
+        self.index = RecentlyAddedIndex(3)
+        self.plex = make_plex(self.index, self.section)
+
+    def test_cold_fetch_is_ordered_by_added_date(self):
+        """The first fetch returns the most recently added videos"""
+        videos = self.plex.fetch_newest('1')
+        self.assertEqual(
+            [video['ratingKey'] for video in videos],
+            ['new-release', 'old-release', 'recent-release'])
+
+    def test_old_release_added_later_is_found(self):
+        """A video released long ago but added since the last fetch is new"""
+        add_videos(self.index, '1', self.plex.fetch_newest('1'))
+        self.section.videos.append(make_video('old-film', 400))
+
+        videos = self.plex.fetch_newest('1')
+        self.assertEqual(
+            [video['ratingKey'] for video in videos], ['old-film'])
+        add_videos(self.index, '1', videos)
+        self.assertEqual(
+            [video['ratingKey'] for video in self.index.get_videos()],
+            ['old-film', 'new-release', 'old-release'])
+        self.assertEqual(self.index.get_cursor('1'), 400)
+
+    def test_unchanged_section_costs_one_item(self):
+        """A section without new videos is checked with one item request"""
+        add_videos(self.index, '1', self.plex.fetch_newest('1'))
+        del self.section.requests[:]
+
+        self.assertEqual(self.plex.fetch_newest('1'), [])
+        self.assertEqual(len(self.section.requests), 1)
+        self.assertEqual(
+            self.section.requests[0][1]['X-Plex-Container-Size'], 1)
+
+
+class RecentlyAddedIndexTest(unittest.TestCase):
+    """Tests the heap of the newest videos across sections"""
+
+    def test_keeps_newest_added_across_sections(self):
+        """Only the most recently added videos of all sections are kept"""
+        index = RecentlyAddedIndex(2)
+        index.add('1', [(100, 'a', {'key': 'a'}), (300, 'b', {'key': 'b'})])
+        index.add('2', [(200, 'c', {'key': 'c'}), (50, 'd', {'key': 'd'})])
+        self.assertEqual(
+            [video['key'] for video in index.get_videos()], ['b', 'c'])
+        self.assertEqual(index.get_minimum(), 200)
+        self.assertEqual(index.get_cursor('2'), 200)
+
+    def test_readded_video_replaces_its_entry(self):
+        """A video seen again is stored once, under its latest addedAt"""
+        index = RecentlyAddedIndex(3)
+        index.add('1', [(100, 'a', {'key': 'a'})])
+        index.add('1', [(150, 'a', {'key': 'a'})])
+        self.assertEqual(len(index.get_videos()), 1)
+        self.assertEqual(index.get_cursor('1'), 150)
+
+
+if __name__ == '__main__':
+    unittest.main()
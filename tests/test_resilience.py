@@ -0,0 +1,57 @@
+"""
+Tests that refresh jobs guarded by circuit breakers survive upstream calls
+that fail or take too long
+"""
+
+import unittest
+
+import gevent
+
+from status.resilience import CircuitBreaker, CircuitTimeoutError
+from status.scheduler import Scheduler
+
+
+class CircuitBreakerTimeoutTest(unittest.TestCase):
+    """Tests the timeouts of calls made through a circuit breaker"""
+
+    def test_timeout_is_an_exception(self):
+        """A call that takes too long raises an ordinary exception"""
+        breaker = CircuitBreaker('slow', timeout=0.01)
+        with self.assertRaises(CircuitTimeoutError):
+            breaker.call(gevent.sleep, 1)
+        self.assertEqual(breaker.failures, 1)
+
+    def test_job_keeps_running_after_timeout(self):
+        """A refresh job keeps its schedule after a call times out"""
+        breaker = CircuitBreaker(
+            'slow', timeout=0.01, failure_threshold=100)
+        scheduler = Scheduler()
+        job = scheduler.add_job(
+            'slow', lambda: breaker.call(gevent.sleep, 1), 0.02,
+            max_backoff=0.02)
+        scheduler.start()
+        gevent.sleep(0.2)
+        greenlet = scheduler._greenlets['slow']
+        self.assertFalse(greenlet.dead)
+        self.assertGreater(job.runs, 1)
+        self.assertEqual(job.errors, job.runs)
+        greenlet.kill()
+
+    def test_job_survives_uncaught_timeout(self):
+        """A gevent.Timeout escaping a job is counted as an error"""
+        def expire():
+            """Raises a timeout that isn't handled by the job"""
+            with gevent.Timeout(0.001):
+                gevent.sleep(1)
+
+        scheduler = Scheduler()
+        job = scheduler.add_job('expire', expire, 0.02, max_backoff=0.02)
+        scheduler.start()
+        gevent.sleep(0.1)
+        greenlet = scheduler._greenlets['expire']
+        self.assertFalse(greenlet.dead)
+        self.assertGreater(job.errors, 1)
+        greenlet.kill()
+
+if __name__ == '__main__':
+    unittest.main()